@@ -1,41 +1,139 @@
 import os
 import sys
+import atexit
+import base64
+import binascii
+import io
+import secrets
 from tkinter import NO
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 import random
+import click
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+from itsdangerous import BadSignature, URLSafeSerializer
 import random
 
-from models import setup_db, Question, Category
+from models import setup_db, on_question_change, Question, Category
+from settings import SECRET_KEY, SEARCH_INDEX_PATH
+from .counts import question_counts
+from .quiz import (ALL_CATEGORIES, QUIZ_PREFETCH_LIMIT, draw_question,
+                   draw_questions, draw_permuted_questions, question_index)
+from .quiz_sessions import quiz_sessions
+from .suggest import SUGGESTION_LIMIT, suggest, suggestion_index
+from .search import memory_enabled, search_index, index_rows, \
+    write_index, InvertedIndex, SearchFilters
+from .cache import search_cache, search_page
+from .search_log import search_log, warm_search_cache
+from .related import RELATED_LIMIT, build_related_questions, \
+    related_questions
+from .bulk import EXPORT_FORMATS, export_questions, import_questions, \
+    read_csv, read_json_rows, read_jsonl, delete_questions, update_questions, \
+    update_question, validate_question, category_ids
 
 QUESTIONS_PER_PAGE = 10
+SEARCH_PAGE_LIMIT = 100
 
 
-def paginate_questions(request, selection):
+def encode_cursor(question_id):
+    return base64.urlsafe_b64encode(str(question_id).encode()).decode()
+
+
+def parse_ids(values):
+    """Read ids given as `ids=1,2&ids=3`, ValueError when one is invalid."""
+    return sorted({int(question_id) for value in values
+                   for question_id in value.split(',')
+                   if question_id.strip()})
+
 
-    page = request.args.get('page', 1, type=int)
-    start = (page-1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400)
 
-    questions_formatted = [question.format() for question in selection]
-    current_questions = questions_formatted[start:end]
 
-    return current_questions
+def paginate_questions(request, selection):
+    """Fetch one page of `selection` (a query ordered by Question.id).
+
+    `?cursor=` (or the raw `?after_id=`) seeks past the last id seen with
+    `WHERE id > :cursor`, so deep pages cost the same as the first one.
+    Without a cursor the classic `?page=` is served with LIMIT/OFFSET.
+    Returns the formatted questions and the cursor of the next page, which
+    is None on the last page.
+    """
+    cursor = request.args.get('cursor', None)
+    after_id = request.args.get('after_id', None, type=int)
+    if cursor is not None:
+        after_id = decode_cursor(cursor)
+
+    if after_id is not None:
+        selection = selection.filter(Question.id > after_id)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], None
+        selection = selection.offset((page-1) * QUESTIONS_PER_PAGE)
+
+    # One extra row tells us whether there is a next page
+    questions = selection.limit(QUESTIONS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(questions) > QUESTIONS_PER_PAGE:
+        questions = questions[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(questions[-1].id)
+
+    current_questions = [question.format() for question in questions]
+
+    return current_questions, next_cursor
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    # Without SECRET_KEY quiz tokens only work on the worker that signed them
+    app.config['SECRET_KEY'] = SECRET_KEY or secrets.token_hex(32)
     setup_db(app)
     CORS(app)
 
+    quiz_tokens = URLSafeSerializer(app.config['SECRET_KEY'],
+                                    salt='quiz-token')
+
+    question_counts.invalidate()
+    on_question_change(question_counts.on_question_event)
+
+    # Quiz draws sample ids from memory, load them before the first request
+    with app.app_context():
+        question_index.rebuild()
+    on_question_change(question_index.on_question_event)
+
+    with app.app_context():
+        suggestion_index.rebuild()
+    on_question_change(suggestion_index.on_question_event)
+
+    search_index.invalidate()
+    if memory_enabled():
+        with app.app_context():
+            search_index.rebuild()
+        on_question_change(search_index.on_question_event)
+
+    # Last, so cached results are dropped once the indexes are up to date
+    search_cache.clear()
+    on_question_change(search_cache.on_question_event)
+
+    # Serve the searches most made lately from the cache from the start
+    with app.app_context():
+        warm_search_cache()
+    atexit.unregister(search_log.flush)
+    atexit.register(search_log.flush)
+
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
                              'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods',
-                             'GET,POST,PUT,DELETE,OPTIONS')
+                             'GET,POST,PUT,PATCH,DELETE,OPTIONS')
 
         return response
 
@@ -55,10 +153,11 @@ def create_app(test_config=None):
     @app.route('/questions')
     def retrieve_questions():
         try:
-            selection = Question.query.order_by(Question.id).all()
+            selection = Question.query.order_by(Question.id)
             categories = Category.query.order_by(Category.id).all()
 
-            current_questions = paginate_questions(request, selection)
+            current_questions, next_cursor = paginate_questions(
+                request, selection)
             categories_formatted = {
                 category.id: category.type for category in categories}
 
@@ -68,11 +167,14 @@ def create_app(test_config=None):
             return jsonify({
                 'success': True,
                 'questions': current_questions,
-                'total_questions': len(selection),
+                'next_cursor': next_cursor,
+                'total_questions': question_counts.total(),
                 'categories': categories_formatted,
                 'current_category': None
 
             })
+        except HTTPException:
+            raise
         except Exception as e:
             print(sys.exc_info())
             abort(404)
@@ -95,6 +197,101 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    @app.route('/questions/<int:question_id>', methods=['PATCH'])
+    def edit_question(question_id):
+        body = request.get_json()
+
+        values, error = validate_question(body, category_ids(), partial=True)
+        if error is not None:
+            return jsonify({
+                'success': False,
+                'error': 400,
+                'message': error
+            }), 400
+        if not values:
+            abort(400)
+
+        try:
+            version = body.get('version', None)
+            question = update_question(
+                question_id, values,
+                int(version) if version is not None else None)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        if question is None:
+            # Without a row, tell a missing question from a stale version
+            if Question.query.get(question_id) is None:
+                abort(404)
+            abort(409)
+
+        return jsonify({
+            'success': True,
+            'question': question
+        })
+
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_by_id():
+        try:
+            ids = parse_ids(request.args.getlist('ids'))
+        except ValueError:
+            abort(400)
+        if not ids:
+            abort(400)
+
+        try:
+            deleted = delete_questions(ids=ids)
+
+            return jsonify({
+                'success': True,
+                'deleted': deleted,
+                'total_deleted': len(deleted)
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/questions/bulk', methods=['PATCH'])
+    def update_questions_in_bulk():
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+
+        ids = body.get('ids', None)
+        from_category = body.get('from_category', None)
+        values = {field: body[field] for field in ('category', 'difficulty')
+                  if body.get(field, None) is not None}
+        if (ids is None) == (from_category is None) or not values:
+            abort(400)
+
+        try:
+            if 'category' in values:
+                values['category'] = str(int(values['category']))
+                if Category.query.get(int(values['category'])) is None:
+                    abort(422)
+            if 'difficulty' in values:
+                values['difficulty'] = int(values['difficulty'])
+
+            if ids is not None:
+                updated = update_questions(
+                    values, ids=sorted({int(question_id)
+                                        for question_id in ids}))
+            else:
+                updated = update_questions(values,
+                                           category=int(from_category))
+
+            return jsonify({
+                'success': True,
+                'updated': updated,
+                'total_updated': len(updated)
+            })
+        except HTTPException:
+            raise
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
     @app.route('/questions', methods=['POST'])
     def create_question():
 
@@ -125,6 +322,82 @@ def create_app(test_config=None):
             print(sys.exc_info())
             abort(422)
 
+    @app.route('/questions/bulk', methods=['POST'])
+    def create_questions():
+        # JSON bodies hold a list, JSON lines and CSV bodies are streamed
+        if request.mimetype == 'application/json':
+            body = request.get_json()
+            if not isinstance(body, dict):
+                abort(400)
+            questions = body.get('questions', None)
+            if not isinstance(questions, list):
+                abort(400)
+            rows = read_json_rows(questions)
+        elif request.mimetype in ('application/x-ndjson', 'text/csv'):
+            lines = io.TextIOWrapper(request.stream, encoding='utf-8',
+                                     newline='')
+            rows = read_csv(lines) if request.mimetype == 'text/csv' \
+                else read_jsonl(lines)
+        else:
+            abort(400)
+
+        try:
+            result = import_questions(rows)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        return jsonify(dict(result.format(), success=True))
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'file_format',
+                  type=click.Choice(['jsonl', 'csv']),
+                  help='Format of the file, by default from its extension.')
+    @click.option('--copy/--no-copy', default=True,
+                  help='Write with COPY on PostgreSQL.')
+    def import_questions_file(path, file_format, copy):
+        """Import the questions of a JSON lines or CSV file."""
+        file_format = file_format or (
+            'csv' if path.lower().endswith('.csv') else 'jsonl')
+        with open(path, encoding='utf-8', newline='') as lines:
+            rows = read_csv(lines) if file_format == 'csv' \
+                else read_jsonl(lines)
+            result = import_questions(rows, copy=copy)
+
+        for error in result.errors:
+            click.echo('row {row}: {error}'.format(**error), err=True)
+        click.echo('Imported {} questions, {} rows failed'.format(
+            result.created, result.failed))
+
+    @app.route('/questions/export')
+    def export_question_bank():
+        file_format = request.args.get('format', 'jsonl')
+        if file_format not in EXPORT_FORMATS:
+            abort(400)
+
+        return Response(
+            stream_with_context(export_questions(file_format)),
+            mimetype='text/csv' if file_format == 'csv'
+            else 'application/x-ndjson',
+            headers={'Content-Disposition':
+                     'attachment; filename=questions.{}'.format(file_format)})
+
+    @app.cli.command('export-questions')
+    @click.option('--output', type=click.File('w', encoding='utf-8'),
+                  default='-', help='File to write to, standard output by '
+                                    'default.')
+    @click.option('--format', 'file_format',
+                  type=click.Choice(EXPORT_FORMATS),
+                  help='Format of the output, by default from its extension '
+                       'or jsonl.')
+    def export_questions_file(output, file_format):
+        """Write every question as JSON lines or CSV."""
+        file_format = file_format or (
+            'csv' if output.name.lower().endswith('.csv') else 'jsonl')
+        for chunk in export_questions(file_format):
+            output.write(chunk)
+
     @app.route('/questions/search', methods=['POST'])
     def search_questions():
 
@@ -132,25 +405,126 @@ def create_app(test_config=None):
         body = request.get_json()
 
         search_term = body.get('searchTerm', None)
+        count_mode = body.get('count', 'exact')
 
         try:
-            # Search for case insensitive strings
-            search_results = Question.query.filter(
-                Question.question.ilike('%{}%'.format(search_term))
-            )
-            questions_formatted = [question.format()
-                                   for question in search_results]
+            limit = min(max(int(body.get('limit', QUESTIONS_PER_PAGE)), 1),
+                        SEARCH_PAGE_LIMIT)
+            if body.get('cursor', None) is not None:
+                offset = decode_cursor(body['cursor'])
+            else:
+                offset = (int(body.get('page', 1)) - 1) * limit
+            if offset < 0:
+                abort(400)
+            filters = SearchFilters.from_body(body)
+
+            (questions_formatted, total_questions, facets,
+             corrected_search_term) = search_page(
+                search_term, offset, limit, count_mode, filters,
+                body.get('autocorrect', False))
+            if offset == 0:
+                search_log.record(search_term, limit, count_mode, filters,
+                                  body.get('autocorrect', False))
+
+            next_cursor = None
+            if (len(questions_formatted) == limit and
+                    offset + limit < total_questions):
+                next_cursor = encode_cursor(offset + limit)
 
             return jsonify({
                 'success': True,
                 'SearchTerm': questions_formatted,
                 'current_category': None,
-                'total_questions': len(search_results.all())
+                'total_questions': total_questions,
+                'next_cursor': next_cursor,
+                'facets': facets,
+                'did_you_mean': corrected_search_term
             })
+        except HTTPException:
+            raise
         except Exception as e:
             print(sys.exc_info())
             abort(422)
 
+    @app.route('/questions/suggest')
+    def suggest_questions():
+        prefix = request.args.get('prefix', None)
+        limit = request.args.get('limit', SUGGESTION_LIMIT, type=int)
+        if prefix is None:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'prefix': prefix,
+            'suggestions': suggest(prefix, min(max(limit, 1),
+                                               SUGGESTION_LIMIT))
+        })
+
+    @app.route('/questions/search/cache')
+    def search_cache_stats():
+        return jsonify({
+            'success': True,
+            'cache': search_cache.stats(),
+            'log': search_log.stats()
+        })
+
+    @app.route('/questions/search/index')
+    def search_index_stats():
+        return jsonify({
+            'success': True,
+            'index': search_index.stats()
+        })
+
+    @app.route('/questions/search/index/rebuild', methods=['POST'])
+    def rebuild_search_index():
+        if not memory_enabled():
+            abort(404)
+
+        try:
+            search_index.rebuild()
+
+            return jsonify({
+                'success': True,
+                'index': search_index.stats()
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(500)
+
+    @app.cli.command('build-search-index')
+    @click.option('--output', default=SEARCH_INDEX_PATH,
+                  help='File to write the index to.')
+    def build_search_index(output):
+        """Write the search index file memory-mapped by the workers."""
+        index = InvertedIndex.build(index_rows())
+        write_index(index, output)
+        click.echo('Indexed {} questions and {} tokens into {}'.format(
+            index.document_count, len(index.postings), output))
+
+    @app.route('/questions/<int:question_id>/related')
+    def get_related_questions(question_id):
+        limit = request.args.get('limit', RELATED_LIMIT, type=int)
+        related = related_questions(question_id,
+                                    min(max(limit, 1), RELATED_LIMIT))
+        if not related and Question.query.get(question_id) is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'question_id': question_id,
+            'questions': [dict(question.format(), score=round(score, 4))
+                          for question, score in related]
+        })
+
+    @app.cli.command('build-related-questions')
+    @click.option('--limit', default=RELATED_LIMIT,
+                  help='Related questions stored per question.')
+    def build_related(limit):
+        """Store the most similar questions of every question."""
+        questions, related = build_related_questions(limit)
+        click.echo('Stored {} related questions for {} questions'.format(
+            related, questions))
+
     @app.route('/categories/<int:category_id>/questions')
     def question_by_category(category_id):
         try:
@@ -168,42 +542,156 @@ def create_app(test_config=None):
             print(sys.exc_info())
             abort(422)
 
+    @app.route('/categories/<int:category_id>/questions', methods=['DELETE'])
+    def delete_questions_by_category(category_id):
+        if Category.query.get(category_id) is None:
+            abort(404)
+
+        try:
+            deleted = delete_questions(category=category_id)
+
+            return jsonify({
+                'success': True,
+                'deleted': deleted,
+                'total_deleted': len(deleted),
+                'current_category': category_id
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    def format_quiz_questions(body, random_questions, response):
+        """Add the drawn questions to the /quizzes `response`.
+
+        `question` is the first one, and all of them are listed in
+        `questions` when the client asked for a `count`.
+        """
+        response['question'] = random_questions[0].format() \
+            if random_questions else None
+        if 'count' in body:
+            response['questions'] = [question.format()
+                                     for question in random_questions]
+        return jsonify(response)
+
     @app.route('/quizzes', methods=['POST'])
     def get_quiz_questions():
         try:
             # Get data from the request body
             body = request.get_json()
-            category: Category = body.get('quiz_category', None)
-            previous_questions_id: list[int] = body.get(
-                'previous_questions', None)
-            is_not_randomQuestion: bool = True
-            while is_not_randomQuestion:
-                all_question_ids = [
-                    question.id for question in Question.query.all()]
-                random_question_id: int = random.choice(all_question_ids)
-                if random_question_id not in previous_questions_id:
-                    random_question: Question = Question.query.get(
-                        random_question_id)
-                    if int(category['id']) == 0:
-                        is_not_randomQuestion == False
-                    if random_question.category == int(category['id']):
-                        is_not_randomQuestion = False
+            count = min(max(int(body.get('count', 1)), 1),
+                        QUIZ_PREFETCH_LIMIT)
+            if 'quiz_token' in body:
+                return quiz_token_questions(body, count)
 
-            return jsonify({
+            category = body.get('quiz_category', None) or {
+                'id': ALL_CATEGORIES}
+            previous_questions_id = body.get('previous_questions', None) or []
+
+            random_questions = draw_questions(
+                int(category['id']),
+                [int(question_id) for question_id in previous_questions_id],
+                count)
+
+            return format_quiz_questions(body, random_questions, {
                 'success': True,
-                'previousQuestions': previous_questions_id,
-                'question': {
-                    'question': random_question.question,
-                    'answer': random_question.answer,
-                    'category': random_question.category,
-                    'difficulty': random_question.difficulty
-                }
+                'previousQuestions': previous_questions_id
             })
 
+        except HTTPException:
+            raise
         except Exception as e:
             print(sys.exc_info())
             abort(422)
 
+    def quiz_token_questions(body, count):
+        """Play the next questions of the quiz signed in `quiz_token`.
+
+        A null token starts a quiz of `quiz_category` in a new random order.
+        """
+        if body['quiz_token'] is None:
+            category = body.get('quiz_category', None) or {
+                'id': ALL_CATEGORIES}
+            quiz = {
+                'category': int(category['id']),
+                'seed': secrets.randbits(32),
+                'position': 0
+            }
+        else:
+            try:
+                quiz = quiz_tokens.loads(body['quiz_token'])
+            except BadSignature:
+                abort(400)
+
+        random_questions, quiz['position'] = draw_permuted_questions(
+            quiz['category'], quiz['seed'], quiz['position'], count)
+
+        return format_quiz_questions(body, random_questions, {
+            'success': True,
+            'quiz_token': quiz_tokens.dumps(quiz)
+        })
+
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def create_quiz_session():
+        try:
+            body = request.get_json()
+            category = body.get('quiz_category', None) or {
+                'id': ALL_CATEGORIES}
+
+            session = quiz_sessions.create(int(category['id']))
+
+            return jsonify({
+                'success': True,
+                'session_id': session.id,
+                'quiz_category': session.category_id
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    def next_quiz_session_question(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+
+        try:
+            random_question = draw_question(
+                session.category_id, session.seen)
+            if random_question is not None:
+                quiz_sessions.mark_seen(session, random_question.id)
+
+            return jsonify({
+                'success': True,
+                'session_id': session.id,
+                'questions_played': len(session.seen),
+                'question': random_question.format()
+                if random_question else None
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/quizzes/index')
+    def quiz_index_stats():
+        return jsonify({
+            'success': True,
+            'index': question_index.stats(),
+            'sessions': quiz_sessions.stats()
+        })
+
+    @app.route('/quizzes/index/rebuild', methods=['POST'])
+    def rebuild_quiz_index():
+        try:
+            question_index.rebuild()
+
+            return jsonify({
+                'success': True,
+                'index': question_index.stats()
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(500)
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({"success": False, "error": 400, "message": "bad request"}), 400
@@ -216,6 +704,10 @@ def create_app(test_config=None):
     def method_not_allowed(error):
         return jsonify({"success": False, "error": 405, "message": "method not allowed"}), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({"success": False, "error": 409, "message": "conflict"}), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({"success": False, "error": 404, "message": "resource not found"}), 422
@@ -0,0 +1,366 @@
+import csv
+import io
+import json
+import logging
+from sqlalchemy import Integer, and_, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from models import db, question_batch, record_question_change, Question, \
+    Category
+from .search import question_rows
+
+logger = logging.getLogger(__name__)
+
+# Rows validated and written together, one transaction each
+IMPORT_CHUNK_SIZE = 1000
+# Row errors listed in an import result, the others are only counted
+MAX_REPORTED_ERRORS = 1000
+
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+# Rows deleted or updated per statement, each in its own transaction to
+# bound how long their locks are held
+WRITE_CHUNK_SIZE = 1000
+
+# Rows exported per chunk of output
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+
+def read_json_rows(questions):
+    """Number the questions of a JSON array from 1."""
+    return enumerate(questions, start=1)
+
+
+def read_jsonl(lines):
+    """Yield the (line number, row) of JSON lines, skipping blank ones.
+
+    Lines that are not valid JSON are yielded as they are, for
+    validate_question to report.
+    """
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, line
+
+
+def read_csv(lines):
+    """Yield the (row number, row) of CSV data rows below the header."""
+    for number, row in enumerate(csv.DictReader(lines), start=1):
+        yield number, row
+
+
+"""
+validate_question(row, categories, partial)
+    the column values of a question to import as (values, None), or
+    (None, error message) when the row cannot be imported
+
+    `categories` holds the ids of the existing categories as strings, the
+    type of the category column. With `partial` only the fields the row
+    holds are validated and returned, as for an update.
+"""
+def validate_question(row, categories, partial=False):
+    if not isinstance(row, dict):
+        return None, 'not a JSON object'
+    fields = [field for field in QUESTION_FIELDS
+              if not partial or field in row]
+    missing = [field for field in fields
+               if row.get(field, None) in (None, '')]
+    if missing:
+        return None, 'missing {}'.format(', '.join(missing))
+
+    values = {field: str(row[field]) for field in fields}
+    if 'category' in values:
+        values['category'] = values['category'].strip()
+        if values['category'] not in categories:
+            return None, 'unknown category {}'.format(row['category'])
+    if 'difficulty' in values:
+        try:
+            values['difficulty'] = int(row['difficulty'])
+        except (TypeError, ValueError):
+            return None, 'difficulty is not an integer'
+    return values, None
+
+
+def category_ids():
+    """Return the ids of the existing categories, as strings."""
+    return {str(category_id) for category_id, in
+            db.session.query(Category.id)}
+
+
+"""
+ImportResult
+    what an import created and the row errors it met
+"""
+class ImportResult:
+
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, row, error):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'error': error})
+
+    def format(self):
+        return {
+            'created': self.created,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+"""
+import_questions(rows, copy, chunk_size)
+    validates and inserts the (number, row) pairs of a reader in chunks,
+    streaming them so the input is never held whole, and returns an
+    ImportResult
+
+    Each chunk is committed on its own. A chunk the database rejects is
+    written again row by row, so only the rows it rejects fail, each with
+    the error of the database, and the import goes on. On PostgreSQL
+    chunks are
+    written with a single multi-row INSERT ... RETURNING whose rows are
+    passed to the question listeners, or with `copy` through COPY, which
+    is faster but leaves the listeners of this process uninformed.
+"""
+def import_questions(rows, copy=False, chunk_size=IMPORT_CHUNK_SIZE):
+    categories = category_ids()
+    result = ImportResult()
+    chunk = []
+    for number, row in rows:
+        values, error = validate_question(row, categories)
+        if error is not None:
+            result.fail(number, error)
+            continue
+        chunk.append((number, values))
+        if len(chunk) >= chunk_size:
+            write_chunk(chunk, result, copy)
+            chunk = []
+    if chunk:
+        write_chunk(chunk, result, copy)
+    return result
+
+
+def write_chunk(chunk, result, copy=False):
+    """Insert a chunk in one transaction, row by row if it is rejected.
+
+    Only a failed write or commit falls back to write_rows; the listeners
+    notified after the commit do not raise (see question_batch).
+    """
+    values = [row_values for _, row_values in chunk]
+    try:
+        with question_batch():
+            if copy and db.engine.dialect.name == 'postgresql':
+                copy_questions(values)
+            else:
+                for question in insert_questions(values):
+                    record_question_change('insert', question)
+    except Exception:
+        logger.warning('chunk of rows %d to %d rejected, writing it row by '
+                       'row', chunk[0][0], chunk[-1][0], exc_info=True)
+        write_rows(chunk, result)
+        return
+
+    result.created += len(values)
+
+
+def write_rows(chunk, result):
+    """Insert a rejected chunk with one savepoint per row, in one transaction.
+
+    Only the rows the database rejects are rolled back and reported.
+    """
+    created = []
+    try:
+        with question_batch():
+            for number, row_values in chunk:
+                try:
+                    with db.session.begin_nested():
+                        question, = insert_questions([row_values])
+                except Exception as error:
+                    result.fail(number, 'rejected by the database: {}'.format(
+                        database_error(error)))
+                    continue
+                record_question_change('insert', question)
+                created.append(number)
+    except Exception:
+        logger.exception('rows %d to %d could not be written',
+                         chunk[0][0], chunk[-1][0])
+        for number in created:
+            result.fail(number, 'rejected by the database')
+        return
+
+    result.created += len(created)
+
+
+def database_error(error):
+    """Return the first line of the message of the driver, or of `error`."""
+    message = str(getattr(error, 'orig', None) or error).strip()
+    return message.splitlines()[0] if message else type(error).__name__
+
+
+def insert_questions(values):
+    """Insert question values, returning the formatted rows."""
+    if db.engine.dialect.name == 'postgresql':
+        columns = Question.__table__.c
+        names = [column.name for column in columns]
+        return [dict(zip(names, row)) for row in db.session.execute(
+            Question.__table__.insert().values(values).returning(*columns))]
+
+    questions = [Question(**row_values) for row_values in values]
+    db.session.add_all(questions)
+    db.session.flush()
+    return [question.format() for question in questions]
+
+
+def copy_questions(values):
+    """Write question values with COPY in the current transaction."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row_values in values:
+        writer.writerow([row_values[field] for field in QUESTION_FIELDS])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY questions ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                ', '.join(QUESTION_FIELDS)), buffer)
+    finally:
+        cursor.close()
+
+
+"""
+export_questions(file_format)
+    yields the question bank as JSON lines or CSV, EXPORT_CHUNK_SIZE rows
+    per string
+
+    Rows are read through a server-side cursor in id order, so only one
+    chunk is ever held in memory. The output can be imported back: the
+    `id` it adds is ignored by import_questions.
+"""
+def export_questions(file_format='jsonl'):
+    fields = ('id',) + QUESTION_FIELDS
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format == 'csv':
+        writer.writerow(fields)
+
+    for count, row in enumerate(question_rows(), start=1):
+        if file_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row))) + '\n')
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def id_condition(ids):
+    """Match the questions `ids`, as one array parameter on PostgreSQL."""
+    if db.engine.dialect.name == 'postgresql':
+        return Question.id == any_(
+            bindparam('ids', list(ids), type_=ARRAY(Integer)))
+    return Question.id.in_(ids)
+
+
+def returning_rows(statement, condition, deleting=False):
+    """Run a DELETE or UPDATE of questions, returning the rows changed.
+
+    PostgreSQL returns them with RETURNING. Elsewhere the rows are read
+    before a DELETE and after an UPDATE.
+    """
+    columns = Question.__table__.c
+    names = [column.name for column in columns]
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.session.execute(
+            statement.where(condition).returning(*columns)).fetchall()
+    else:
+        ids = [question_id for question_id, in
+               db.session.query(Question.id).filter(condition)]
+        condition = Question.id.in_(ids)
+        rows = db.session.query(*columns).filter(condition).all() \
+            if deleting else []
+        db.session.execute(statement.where(condition))
+        if not deleting:
+            rows = db.session.query(*columns).filter(condition).all()
+    return [dict(zip(names, row)) for row in rows]
+
+
+"""
+change_questions(statement, event, ids, category)
+    runs a DELETE or UPDATE statement over the questions `ids`, or over
+    those of `category`, and returns the ids of the questions changed
+
+    The questions are changed WRITE_CHUNK_SIZE at a time, one statement
+    and one transaction each, so locks are held briefly however many rows
+    change. The chunks of a category are taken in id order by a subquery
+    of the statement itself. The changed rows are passed to the question
+    listeners as `event`.
+"""
+def change_questions(statement, event, ids=None, category=None):
+    changed = []
+    start = 0
+    last_id = 0
+    while True:
+        if ids is not None:
+            if start >= len(ids):
+                break
+            condition = id_condition(ids[start:start + WRITE_CHUNK_SIZE])
+            start += WRITE_CHUNK_SIZE
+        else:
+            condition = Question.id.in_(db.session.query(Question.id).filter(
+                Question.category == str(category), Question.id > last_id
+            ).order_by(Question.id).limit(WRITE_CHUNK_SIZE))
+
+        with question_batch():
+            rows = returning_rows(statement, condition, event == 'delete')
+            for question in rows:
+                record_question_change(event, question)
+        changed.extend(question['id'] for question in rows)
+
+        if ids is None:
+            if not rows:
+                break
+            last_id = max(question['id'] for question in rows)
+    return changed
+
+
+def delete_questions(ids=None, category=None):
+    return change_questions(Question.__table__.delete(), 'delete',
+                            ids, category)
+
+
+def update_questions(values, ids=None, category=None):
+    return change_questions(Question.__table__.update().values(
+        version=Question.version + 1, **values), 'update', ids, category)
+
+
+"""
+update_question(question_id, values, version)
+    sets the given columns of a question with a single UPDATE ... RETURNING
+    and returns its formatted row, or None when the question does not
+    exist or, given `version`, was updated since
+
+    Checking the version in the statement itself detects concurrent edits
+    without locking the row between reading and writing it.
+"""
+def update_question(question_id, values, version=None):
+    condition = Question.id == question_id
+    if version is not None:
+        condition = and_(condition, Question.version == version)
+
+    with question_batch():
+        rows = returning_rows(Question.__table__.update().values(
+            version=Question.version + 1, **values), condition)
+        for question in rows:
+            record_question_change('update', question)
+    return rows[0] if rows else None
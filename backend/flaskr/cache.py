@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+from settings import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+from .search import normalize_search_term, run_search
+from .suggest import did_you_mean
+
+
+"""
+ResultCache
+    bounded least recently used cache whose entries expire after `ttl`
+    seconds
+
+    Entries are tagged with the generation they were stored in. Any
+    question write bumps the generation, which turns every older entry
+    into a miss without walking the cache.
+"""
+class ResultCache:
+
+    def __init__(self, max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value of `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, stored_at, value = entry
+                if (generation == self.generation and
+                        time.monotonic() - stored_at < self.ttl):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation=None):
+        """Store `value`, unless it was computed before the last write."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is None:
+                generation = self.generation
+            elif generation != self.generation:
+                return
+            self._entries[key] = (generation, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def on_question_event(self, event, question):
+        self.bump()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+search_cache = ResultCache()
+
+
+"""
+search_page(search_term, offset, limit, count_mode, filters, autocorrect)
+    one page of formatted search results as (questions, total_questions,
+    facets, corrected_search_term), served from search_cache when the same
+    normalized search was made since the last question write
+"""
+def search_page(search_term, offset, limit, count_mode, filters,
+                autocorrect):
+    key = (normalize_search_term(search_term), offset, limit, count_mode,
+           filters.key(), bool(autocorrect))
+    results = search_cache.get(key)
+    if results is None:
+        generation = search_cache.generation
+        results = run_search_page(search_term, offset, limit, count_mode,
+                                  filters, autocorrect)
+        search_cache.set(key, results, generation)
+    return results
+
+
+def run_search_page(search_term, offset, limit, count_mode, filters,
+                    autocorrect):
+    hits, total_questions, facets = run_search(
+        search_term, offset, limit, count_mode, filters)
+
+    # Only failed searches pay for the spelling correction
+    corrected_search_term = None
+    if not total_questions:
+        corrected_search_term = did_you_mean(search_term)
+        if corrected_search_term and autocorrect:
+            hits, total_questions, facets = run_search(
+                corrected_search_term, offset, limit, count_mode, filters)
+
+    return ([dict(question.format(), highlights=highlights)
+             for question, highlights in hits], total_questions,
+            facets.format() if facets else None, corrected_search_term)
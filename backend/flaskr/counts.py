@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from sqlalchemy import func
+
+from models import db, Question
+from settings import COUNT_CACHE_TTL
+
+
+def category_key(category):
+    try:
+        return int(category)
+    except (TypeError, ValueError):
+        return category
+
+
+"""
+QuestionCounts
+    exact question totals per category, kept in process
+
+    The counters are loaded with one grouped COUNT query and then adjusted
+    as questions are inserted or deleted in this process. Writes made by
+    other workers are picked up when the counters expire after `ttl`
+    seconds.
+"""
+class QuestionCounts:
+
+    def __init__(self, ttl=COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_category = None
+        self._loaded_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._by_category = None
+
+    def _load(self):
+        rows = db.session.query(
+            Question.category, func.count(Question.id)
+        ).group_by(Question.category).all()
+        return {category_key(category): total for category, total in rows}
+
+    def _counts(self):
+        with self._lock:
+            if (self._by_category is not None and
+                    time.monotonic() - self._loaded_at < self.ttl):
+                return self._by_category
+
+        by_category = self._load()
+        with self._lock:
+            self._by_category = by_category
+            self._loaded_at = time.monotonic()
+        return by_category
+
+    def total(self):
+        return sum(self._counts().values())
+
+    def for_category(self, category_id):
+        return self._counts().get(category_key(category_id), 0)
+
+    def on_question_event(self, event, question):
+        with self._lock:
+            if self._by_category is None:
+                return
+            key = category_key(question['category'])
+            if event == 'insert':
+                self._by_category[key] = self._by_category.get(key, 0) + 1
+            elif event == 'delete':
+                self._by_category[key] = max(
+                    self._by_category.get(key, 0) - 1, 0)
+            else:
+                # The previous category of an updated row is unknown
+                self._by_category = None
+
+
+question_counts = QuestionCounts()
+
+
+"""
+count_questions(query, mode)
+    counts the rows matched by `query` without fetching them
+
+    mode 'exact' runs SELECT count(*) over the query. mode 'estimated' reads
+    the row estimate of the PostgreSQL planner, which is close enough for
+    large result sets and does not scan them; other dialects fall back to
+    the exact count.
+"""
+def count_questions(query, mode='exact'):
+    query = query.order_by(None)
+    if mode == 'estimated' and db.engine.dialect.name == 'postgresql':
+        return estimate_count(query)
+    return query.count()
+
+
+def estimate_count(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,117 @@
+import re
+from sqlalchemy import func
+
+from models import Category
+
+# An optional '-', an optional 'field:' and a quoted phrase or a word
+QUERY_PATTERN = re.compile(r'(-?)(?:(\w+):)?(?:"([^"]*)"?|(\S+))')
+
+QUERY_FIELDS = ('category',)
+
+
+"""
+SearchQuery
+    a search term parsed by parse_query
+
+    `clauses` must all match, each clause being a list of alternative
+    phrases; none of the `excluded` phrases may match. `category` is the
+    raw value of a `category:` prefix, or None.
+"""
+class SearchQuery:
+
+    def __init__(self, clauses=None, excluded=None, category=None):
+        self.clauses = clauses or []
+        self.excluded = excluded or []
+        self.category = category
+
+    def __bool__(self):
+        return bool(self.clauses or self.excluded)
+
+    def __str__(self):
+        parts = [' OR '.join(quote(phrase) for phrase in clause)
+                 for clause in self.clauses]
+        parts += ['-' + quote(phrase) for phrase in self.excluded]
+        if self.category is not None:
+            parts.append('category:' + quote(self.category))
+        return ' '.join(parts)
+
+    @property
+    def phrases(self):
+        """The phrases that must or may match, without the excluded ones."""
+        return [phrase for clause in self.clauses for phrase in clause]
+
+    def map(self, function):
+        """Return the query with every phrase replaced by function(phrase)."""
+        clauses = [[function(phrase) for phrase in clause]
+                   for clause in self.clauses]
+        excluded = [function(phrase) for phrase in self.excluded]
+        return SearchQuery(
+            [[phrase for phrase in clause if phrase] for clause in clauses
+             if any(clause)],
+            [phrase for phrase in excluded if phrase],
+            self.category)
+
+    def normalized(self, normalize=str.lower):
+        """Return the query with its phrases and category normalized."""
+        query = self.map(normalize)
+        if query.category is not None:
+            query.category = query.category.lower()
+        return query
+
+
+def quote(phrase):
+    if re.fullmatch(r'[^\s"-]\S*', phrase) and ':' not in phrase and \
+            phrase != 'OR':
+        return phrase
+    return '"{}"'.format(phrase.replace('"', ''))
+
+
+"""
+parse_query(search_term)
+    parses the search term into a SearchQuery
+
+    Words and "quoted phrases" must all match. `OR` between two of them
+    lets either match, a leading `-` excludes the word or phrase, and
+    `category:` followed by a category id or type (quoted when it holds
+    spaces) narrows the search to that category.
+"""
+def parse_query(search_term):
+    query = SearchQuery()
+    alternative = False
+    search_term = '' if search_term is None else '{}'.format(search_term)
+    for match in QUERY_PATTERN.finditer(search_term):
+        negated, field, quoted, word = match.groups()
+        text = quoted if quoted is not None else word
+        if not negated and field is None and word == 'OR':
+            alternative = bool(query.clauses)
+            continue
+
+        if field is not None:
+            if field.lower() in QUERY_FIELDS and not negated:
+                query.category = ' '.join(text.split())
+                alternative = False
+                continue
+            text = '{}:{}'.format(field, text)
+
+        phrase = ' '.join(text.split())
+        if not phrase:
+            continue
+        if negated:
+            query.excluded.append(phrase)
+        elif alternative:
+            query.clauses[-1].append(phrase)
+        else:
+            query.clauses.append([phrase])
+        alternative = False
+    return query
+
+
+def resolve_category(category):
+    """Return the id of a category given by id or type, ValueError if none."""
+    if category.isdigit():
+        return int(category)
+    match = Category.query.filter(
+        func.lower(Category.type) == category.lower()).first()
+    if match is None:
+        raise ValueError('unknown category {!r}'.format(category))
+    return match.id
@@ -0,0 +1,337 @@
+import hashlib
+import random
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Question
+from settings import QUIZ_INDEX_TTL
+from .counts import category_key
+
+ALL_CATEGORIES = 0
+
+# Random picks tried before falling back to scanning the remaining ids
+SAMPLE_ATTEMPTS = 8
+
+FEISTEL_ROUNDS = 4
+
+# Most questions /quizzes hands out in one request
+QUIZ_PREFETCH_LIMIT = 50
+
+
+def _feistel_round(seed, round_number, value):
+    digest = hashlib.blake2b(
+        '{}:{}:{}'.format(seed, round_number, value).encode(),
+        digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+"""
+feistel_permute(position, size, seed)
+    maps position to its place in a pseudo-random permutation of
+    range(size) chosen by seed
+
+    A balanced Feistel network is a bijection over the smallest even number
+    of bits covering size; results outside range(size) are fed back in
+    (cycle walking) until they land inside it, which keeps it a bijection.
+"""
+def feistel_permute(position, size, seed):
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    value = position
+    while True:
+        left, right = value >> half_bits, value & mask
+        for round_number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ (
+                _feistel_round(seed, round_number, right) & mask)
+        value = (left << half_bits) | right
+        if value < size:
+            return value
+
+
+"""
+QuestionIdIndex
+    sorted question ids per category, plus one array for all categories
+
+    Ids are kept in compact array('i') so quiz draws can sample uniformly
+    without touching the database. The index follows the writes of this
+    process and is rebuilt after `ttl` seconds to pick up the writes of
+    other workers. As for SearchIndex, that rebuild runs in a background
+    thread and replays the writes made meanwhile before swapping in the
+    new arrays; only the first build makes a draw wait.
+"""
+class QuestionIdIndex:
+
+    def __init__(self, ttl=QUIZ_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._all = None
+        self._by_category = {}
+        self._events = None
+        self._refreshing = False
+        self._built_at = 0.0
+        self._rebuild_seconds = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._all = None
+            self._by_category = {}
+
+    def rebuild(self):
+        """Read the ids again, holding the lock only to swap them in."""
+        with self._rebuild_lock:
+            started = time.monotonic()
+            with self._lock:
+                self._events = []
+            try:
+                all_ids = array('i')
+                by_category = {}
+                rows = db.session.query(
+                    Question.id, Question.category).order_by(Question.id)
+                for question_id, category in rows:
+                    all_ids.append(question_id)
+                    by_category.setdefault(
+                        category_key(category), array('i')).append(
+                        question_id)
+            except BaseException:
+                with self._lock:
+                    self._events = None
+                raise
+
+            with self._lock:
+                events, self._events = self._events, None
+                self._all = all_ids
+                self._by_category = by_category
+                for event, question in events:
+                    self._apply(event, question)
+                self._built_at = time.monotonic()
+                self._rebuild_seconds = self._built_at - started
+
+    def _refresh(self, app):
+        """Rebuild in a background thread, unless one is running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                print(sys.exc_info())
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _ensure_built(self):
+        if self._all is None:
+            self.rebuild()
+        elif time.monotonic() - self._built_at >= self.ttl:
+            self._refresh(current_app._get_current_object())
+
+    def _ids(self, category_id):
+        if category_id == ALL_CATEGORIES:
+            return self._all
+        return self._by_category.get(category_key(category_id), array('i'))
+
+    def ids(self, category_id):
+        self._ensure_built()
+        with self._lock:
+            return array('i', self._ids(category_id))
+
+    def sample(self, category_id, excluded_ids, count=1):
+        """Return up to `count` random ids of the category not excluded.
+
+        `excluded_ids` is any container with a fast `in`, such as a set.
+        """
+        self._ensure_built()
+        picked = []
+        with self._lock:
+            ids = self._ids(category_id)
+            if not ids:
+                return picked
+            for _ in range(count * SAMPLE_ATTEMPTS):
+                question_id = ids[random.randrange(len(ids))]
+                if (question_id not in excluded_ids and
+                        question_id not in picked):
+                    picked.append(question_id)
+                    if len(picked) == count:
+                        return picked
+            remaining = [question_id for question_id in ids
+                         if question_id not in excluded_ids and
+                         question_id not in picked]
+        return picked + random.sample(
+            remaining, min(count - len(picked), len(remaining)))
+
+    def permuted_id(self, category_id, seed, position):
+        """Return the id at `position` of the category shuffled by `seed`.
+
+        None once `position` is past the last question of the category.
+        """
+        self._ensure_built()
+        with self._lock:
+            ids = self._ids(category_id)
+            if position >= len(ids):
+                return None
+            return ids[feistel_permute(position, len(ids), seed)]
+
+    def _add(self, ids, question_id):
+        position = bisect_left(ids, question_id)
+        if position == len(ids) or ids[position] != question_id:
+            insort(ids, question_id)
+
+    def _discard(self, ids, question_id):
+        position = bisect_left(ids, question_id)
+        if position < len(ids) and ids[position] == question_id:
+            del ids[position]
+
+    def _apply(self, event, question):
+        if event != 'insert':
+            # A deleted question goes away, an updated one may have moved
+            self._discard(self._all, question['id'])
+            for ids in self._by_category.values():
+                self._discard(ids, question['id'])
+        if event != 'delete':
+            self._add(self._all, question['id'])
+            self._add(self._by_category.setdefault(
+                category_key(question['category']), array('i')),
+                question['id'])
+
+    def discard(self, question_id):
+        self.on_question_event('delete', {'id': question_id})
+
+    def on_question_event(self, event, question):
+        with self._lock:
+            if self._events is not None:
+                self._events.append((event, question))
+            if self._all is not None:
+                self._apply(event, question)
+
+    def stats(self):
+        with self._lock:
+            arrays = [self._all or array('i')] + list(
+                self._by_category.values())
+            return {
+                'built': self._all is not None,
+                'questions': len(self._all or ()),
+                'categories': len(self._by_category),
+                'bytes': sum(ids.itemsize * len(ids) for ids in arrays),
+                'rebuild_seconds': round(self._rebuild_seconds, 6),
+                'age_seconds': round(time.monotonic() - self._built_at, 3)
+                if self._all is not None else None,
+                'rebuilding': self._refreshing,
+            }
+
+
+question_index = QuestionIdIndex()
+
+
+def eligible_questions(category_id, previous_ids):
+    query = Question.query
+    if category_id != ALL_CATEGORIES:
+        query = query.filter(Question.category == category_id)
+    if previous_ids:
+        query = query.filter(~Question.id.in_(list(previous_ids)))
+    return query
+
+
+class ExcludedIds:
+    """Container of the ids found in any of `containers`."""
+
+    def __init__(self, *containers):
+        self.containers = containers
+
+    def __contains__(self, question_id):
+        return any(question_id in ids for ids in self.containers)
+
+    def __iter__(self):
+        for ids in self.containers:
+            yield from ids
+
+
+def fetch_questions(question_ids):
+    """Fetch `question_ids` in one query, in the same order.
+
+    Ids missing from the database were deleted by another worker, they
+    are dropped from the index and left out of the result.
+    """
+    found = {question.id: question for question in
+             Question.query.filter(Question.id.in_(question_ids))}
+    for question_id in question_ids:
+        if question_id not in found:
+            question_index.discard(question_id)
+    return [found[question_id] for question_id in question_ids
+            if question_id in found]
+
+
+"""
+draw_questions(category_id, previous_ids, count)
+    picks up to `count` distinct random questions of the category (0 for all
+    categories) that are not in previous_ids; fewer are returned once the
+    category runs out of questions
+
+    The ids are sampled from the in-process index so only the chosen rows
+    are fetched, in a single query. Ids deleted by another worker are
+    redrawn; an ORDER BY random() query is the last resort.
+"""
+def draw_questions(category_id, previous_ids, count=1):
+    if isinstance(previous_ids, list):
+        previous_ids = set(previous_ids)
+
+    questions = []
+    for _ in range(SAMPLE_ATTEMPTS):
+        question_ids = question_index.sample(
+            category_id,
+            ExcludedIds(previous_ids,
+                        {question.id for question in questions}),
+            count - len(questions))
+        if not question_ids:
+            return questions
+        fetched = fetch_questions(question_ids)
+        questions.extend(fetched)
+        if len(questions) == count or len(fetched) == len(question_ids):
+            return questions
+
+    excluded_ids = list(ExcludedIds(
+        previous_ids, [question.id for question in questions]))
+    return questions + eligible_questions(category_id, excluded_ids).order_by(
+        func.random()).limit(count - len(questions)).all()
+
+
+def draw_question(category_id, previous_ids):
+    questions = draw_questions(category_id, previous_ids)
+    return questions[0] if questions else None
+
+
+"""
+draw_permuted_questions(category_id, seed, position, count)
+    fetches up to `count` questions from `position` of the quiz shuffled by
+    `seed` and returns them with the position of the following question
+
+    Nothing is stored between draws: the seed and position are enough to
+    continue the quiz on any worker. Questions added or deleted during a
+    quiz can be skipped or played twice.
+"""
+def draw_permuted_questions(category_id, seed, position, count=1):
+    questions = []
+    while len(questions) < count:
+        question_ids = []
+        while len(question_ids) < count - len(questions):
+            question_id = question_index.permuted_id(
+                category_id, seed, position)
+            if question_id is None:
+                break
+            question_ids.append(question_id)
+            position += 1
+        if not question_ids:
+            break
+        questions.extend(fetch_questions(question_ids))
+    return questions, position
@@ -0,0 +1,160 @@
+import secrets
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from settings import QUIZ_SESSION_TTL, QUIZ_SESSION_MAX_BYTES
+
+# Rough size of a session besides its seen ids, for the memory budget
+SESSION_OVERHEAD_BYTES = 256
+
+
+"""
+SeenIds
+    set of question ids, held as a sorted array('i') while that is smaller
+    than a bitset of one bit per id up to the largest one
+
+    A session only pays for the questions it played, a few bytes each,
+    however large the ids of the bank are. Once a session has played a
+    large share of the ids below its largest one, the array is swapped for
+    the bitset, which is then the smaller of the two.
+"""
+class SeenIds:
+
+    def __init__(self):
+        self._ids = array('i')
+        self._bits = None
+        self._count = 0
+
+    def add(self, question_id):
+        if self._bits is not None:
+            self._set_bit(question_id)
+            return
+
+        position = bisect_left(self._ids, question_id)
+        if position < len(self._ids) and self._ids[position] == question_id:
+            return
+        self._ids.insert(position, question_id)
+        self._count += 1
+        if self._ids.itemsize * len(self._ids) > self._ids[-1] // 8 + 1:
+            ids, self._ids = self._ids, array('i')
+            self._bits = bytearray(ids[-1] // 8 + 1)
+            self._count = 0
+            for seen_id in ids:
+                self._set_bit(seen_id)
+
+    def _set_bit(self, question_id):
+        byte, bit = divmod(question_id, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte + 1 - len(self._bits)))
+        if not self._bits[byte] & (1 << bit):
+            self._bits[byte] |= 1 << bit
+            self._count += 1
+
+    def __contains__(self, question_id):
+        if self._bits is not None:
+            byte, bit = divmod(question_id, 8)
+            return byte < len(self._bits) and bool(
+                self._bits[byte] & (1 << bit))
+        position = bisect_left(self._ids, question_id)
+        return position < len(self._ids) and self._ids[position] == question_id
+
+    def __iter__(self):
+        if self._bits is None:
+            yield from self._ids
+            return
+        for byte, value in enumerate(self._bits):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield byte * 8 + bit
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        if self._bits is not None:
+            return len(self._bits)
+        return self._ids.itemsize * len(self._ids)
+
+
+class QuizSession:
+
+    def __init__(self, category_id):
+        self.id = secrets.token_urlsafe(16)
+        self.category_id = category_id
+        self.seen = SeenIds()
+        self.last_used = time.monotonic()
+
+    @property
+    def nbytes(self):
+        return SESSION_OVERHEAD_BYTES + self.seen.nbytes
+
+
+"""
+QuizSessionStore
+    quiz sessions of this process, least recently used first
+
+    Sessions idle for more than `ttl` seconds are dropped, and the least
+    recently used ones are evicted whenever the sessions together use more
+    than `max_bytes`.
+"""
+class QuizSessionStore:
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL, max_bytes=QUIZ_SESSION_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._nbytes = 0
+
+    def _evict(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._nbytes -= session.nbytes
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if (now - session.last_used < self.ttl and
+                    self._nbytes <= self.max_bytes):
+                break
+            self._evict(session_id)
+
+    def create(self, category_id):
+        session = QuizSession(category_id)
+        with self._lock:
+            self._sessions[session.id] = session
+            self._nbytes += session.nbytes
+            self._expire()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def mark_seen(self, session, question_id):
+        with self._lock:
+            nbytes = session.nbytes
+            session.seen.add(question_id)
+            if session.id in self._sessions:
+                self._nbytes += session.nbytes - nbytes
+            self._expire()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self._nbytes,
+            }
+
+
+quiz_sessions = QuizSessionStore()
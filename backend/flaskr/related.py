@@ -0,0 +1,140 @@
+from array import array
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Question, RelatedQuestion
+from .search import question_rows, tokenize
+
+# Neighbours stored per question, the most /questions/<id>/related returns
+RELATED_LIMIT = 10
+
+# Only the heaviest terms of each question are compared, and terms held by
+# more than MAX_POSTINGS questions are left out: their weight is low and
+# walking them would make the job quadratic in the size of the bank.
+TERMS_PER_QUESTION = 16
+MAX_POSTINGS = 2000
+
+# Questions whose similarities are computed by one sparse product
+BLOCK_SIZE = 1024
+
+# Neighbour rows written at once
+INSERT_CHUNK_SIZE = 5000
+
+
+"""
+TfidfMatrix
+    sparse TF-IDF vectors of the question and answer texts
+
+    `vectors` is a scipy CSR matrix with a row per question of `ids`.
+    Weights are (1 + log tf) * idf, normalized to unit length, so the dot
+    product of two rows is their cosine similarity. Only the
+    TERMS_PER_QUESTION heaviest terms of a row are kept, and `postings`,
+    the transposed matrix the rows are multiplied by, leaves out the terms
+    of more than MAX_POSTINGS questions.
+"""
+class TfidfMatrix:
+
+    def __init__(self, ids, vectors, postings):
+        self.ids = ids
+        self.vectors = vectors
+        self.postings = postings
+
+    @classmethod
+    def build(cls, rows):
+        ids = array('i')
+        row_ends = array('q', [0])
+        terms = array('i')
+        counts = array('i')
+        vocabulary = {}
+        for question_id, question, answer, _, _ in rows:
+            token_counts = Counter(tokenize(question) + tokenize(answer))
+            ids.append(question_id)
+            terms.extend(vocabulary.setdefault(token, len(vocabulary))
+                         for token in token_counts)
+            counts.extend(token_counts.values())
+            row_ends.append(len(terms))
+
+        ids = np.frombuffer(ids, dtype=np.int32)
+        row_ends = np.frombuffer(row_ends, dtype=np.int64)
+        terms = np.frombuffer(terms, dtype=np.int32)
+        counts = np.frombuffer(counts, dtype=np.int32)
+        row_positions = np.repeat(np.arange(len(ids)), np.diff(row_ends))
+
+        frequencies = np.bincount(terms, minlength=len(vocabulary))
+        idfs = np.log((1 + len(ids)) / (1 + frequencies)) + 1
+        weights = (1 + np.log(counts)) * idfs[terms]
+        norms = np.sqrt(np.bincount(row_positions, weights * weights,
+                                    minlength=len(ids)))
+        weights /= np.where(norms > 0, norms, 1.0)[row_positions]
+
+        # Heaviest terms first within each row, then keep the first ones
+        order = np.lexsort((-weights, row_positions))
+        ranks = np.arange(len(order)) - row_ends[row_positions[order]]
+        kept = np.sort(order[ranks < TERMS_PER_QUESTION])
+        vectors = sparse.csr_matrix(
+            (weights[kept].astype(np.float32), terms[kept],
+             np.searchsorted(row_positions[kept], np.arange(len(ids) + 1))),
+            shape=(len(ids), len(vocabulary)))
+        common = sparse.diags((frequencies <= MAX_POSTINGS).astype(
+            np.float32))
+        return cls(ids, vectors, (vectors @ common).T.tocsr())
+
+    def neighbours(self, start, stop, limit=RELATED_LIMIT):
+        """Yield (position, [(other position, score), ...]) for the rows
+        from `start` to `stop`, the `limit` most similar others first."""
+        scores = (self.vectors[start:stop] @ self.postings).tocsr()
+        for position in range(start, stop):
+            begin, end = scores.indptr[position - start:position - start + 2]
+            others = scores.indices[begin:end]
+            values = scores.data[begin:end]
+            if len(values) > limit + 1:
+                best = np.argpartition(values, -limit - 1)[-limit - 1:]
+                others, values = others[best], values[best]
+            yield position, sorted(
+                ((other, score) for other, score in
+                 zip(others.tolist(), values.tolist()) if other != position),
+                key=lambda pair: (-pair[1], pair[0]))[:limit]
+
+
+"""
+build_related_questions(limit)
+    computes the `limit` nearest neighbours of every question and replaces
+    the stored lists in a single transaction, so /questions/<id>/related
+    serves the previous lists until the new ones are committed; returns
+    the numbers of questions and of neighbours written
+"""
+def build_related_questions(limit=RELATED_LIMIT):
+    matrix = TfidfMatrix.build(question_rows())
+    RelatedQuestion.query.delete()
+
+    ids = matrix.ids.tolist()
+    chunk = []
+    written = 0
+    for start in range(0, len(ids), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(ids))
+        for position, neighbours in matrix.neighbours(start, stop, limit):
+            chunk.extend({'question_id': ids[position],
+                          'related_id': ids[other],
+                          'score': score} for other, score in neighbours)
+        if len(chunk) >= INSERT_CHUNK_SIZE:
+            db.session.execute(RelatedQuestion.__table__.insert(), chunk)
+            written += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(RelatedQuestion.__table__.insert(), chunk)
+        written += len(chunk)
+    db.session.commit()
+    return len(ids), written
+
+
+def related_questions(question_id, limit=RELATED_LIMIT):
+    """Return the stored neighbours of a question as (question, score)."""
+    return db.session.query(Question, RelatedQuestion.score).join(
+        RelatedQuestion, RelatedQuestion.related_id == Question.id
+    ).filter(
+        RelatedQuestion.question_id == question_id
+    ).order_by(
+        RelatedQuestion.score.desc(), Question.id
+    ).limit(limit).all()
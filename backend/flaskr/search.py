@@ -0,0 +1,967 @@
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from functools import reduce
+from flask import current_app
+from sqlalchemy import func, literal_column, not_, or_
+
+from models import db, Question
+from .counts import category_key, count_questions
+from .query import parse_query, resolve_category
+from settings import SEARCH_MODE, SEARCH_LANGUAGE, SEARCH_INDEX_TTL, \
+    SEARCH_INDEX_PATH
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Questions whose texts are read at once to confirm phrases
+PHRASE_CHUNK_SIZE = 500
+# Questions changed since the search index file read at once to index them
+REINDEX_CHUNK_SIZE = 500
+
+
+def tokenize(text):
+    return [sys.intern(token)
+            for token in TOKEN_PATTERN.findall((text or '').lower())]
+
+
+def normalize_search_term(search_term, mode=SEARCH_MODE):
+    """Return the form shared by the search terms giving the same results."""
+    query = parse_query(search_term)
+    if memory_enabled(mode):
+        return str(query.normalized(index_phrase))
+    return str(query.normalized())
+
+
+def index_phrase(phrase):
+    """Return `phrase` as the words the search index holds."""
+    return ' '.join(tokenize(phrase))
+
+
+def fulltext_enabled(mode=SEARCH_MODE):
+    return mode == 'fulltext' and db.engine.dialect.name == 'postgresql'
+
+
+def memory_enabled(mode=SEARCH_MODE):
+    return mode == 'memory'
+
+
+"""
+SearchFilters
+    category and difficulty range narrowing a search, None when unused
+
+    Category 0 stands for all categories, as in quizzes.
+"""
+class SearchFilters:
+
+    def __init__(self, category=None, difficulty_min=None,
+                 difficulty_max=None):
+        self.category = category or None
+        self.difficulty_min = difficulty_min
+        self.difficulty_max = difficulty_max
+
+    @classmethod
+    def from_body(cls, body):
+        """Read the filters of a request body, ValueError when invalid."""
+        values = [body.get(name, None) for name in
+                  ('category', 'difficulty_min', 'difficulty_max')]
+        return cls(*[int(value) if value is not None else None
+                     for value in values])
+
+    def __bool__(self):
+        return any(value is not None for value in self.key())
+
+    def key(self):
+        return self.category, self.difficulty_min, self.difficulty_max
+
+    def apply(self, query):
+        if self.category is not None:
+            query = query.filter(Question.category == self.category)
+        if self.difficulty_min is not None:
+            query = query.filter(Question.difficulty >= self.difficulty_min)
+        if self.difficulty_max is not None:
+            query = query.filter(Question.difficulty <= self.difficulty_max)
+        return query
+
+    def narrowed(self, query):
+        """Return the filters with the category of the `category:` prefix."""
+        if query.category is None:
+            return self
+        return SearchFilters(resolve_category(query.category),
+                             self.difficulty_min, self.difficulty_max)
+
+    def accepts(self, category, difficulty):
+        """Tell whether indexed category and difficulty values match."""
+        if self.category is not None and category != self.category:
+            return False
+        if self.difficulty_min is not None and (
+                difficulty == NO_VALUE or difficulty < self.difficulty_min):
+            return False
+        if self.difficulty_max is not None and (
+                difficulty == NO_VALUE or difficulty > self.difficulty_max):
+            return False
+        return True
+
+
+"""
+search_query(query, filters)
+    builds the query of the questions matching the parsed search query,
+    best first
+
+    The whole search query compiles to a single predicate, so the
+    PostgreSQL planner evaluates its most selective part first. The
+    filters come first so it can narrow the rows with the
+    (category, difficulty) index before matching the text.
+
+    In 'fulltext' mode on PostgreSQL the phrases are compiled into one
+    tsquery, matched against the GIN-indexed search_vector column and
+    ranked with ts_rank. Otherwise questions containing the phrases are
+    matched case insensitively with ILIKE, which the pg_trgm index of
+    'trigram' mode serves without a sequential scan.
+"""
+def search_query(query, filters=None, mode=SEARCH_MODE):
+    questions = filters.apply(Question.query) if filters else Question.query
+    if not query:
+        return questions.order_by(Question.id)
+
+    if fulltext_enabled(mode):
+        tsquery = to_tsquery(query)
+        search_vector = literal_column('questions.search_vector')
+        return questions.filter(
+            search_vector.op('@@')(tsquery)
+        ).order_by(
+            func.ts_rank(search_vector, tsquery).desc(), Question.id)
+
+    conditions = [or_(*[contains(phrase) for phrase in clause])
+                  for clause in query.clauses]
+    conditions += [not_(contains(phrase)) for phrase in query.excluded]
+    return questions.filter(*conditions).order_by(Question.id)
+
+
+def contains(phrase):
+    return Question.question.ilike('%{}%'.format(phrase))
+
+
+def to_tsquery(query):
+    """Compile the parsed search query into a PostgreSQL tsquery."""
+    def phrase_tsquery(phrase):
+        return func.phraseto_tsquery(SEARCH_LANGUAGE, phrase)
+
+    conditions = [reduce(func.tsquery_or, map(phrase_tsquery, clause))
+                  for clause in query.clauses]
+    conditions += [func.tsquery_not(phrase_tsquery(phrase))
+                   for phrase in query.excluded]
+    return reduce(func.tsquery_and, conditions)
+
+
+# Markers ts_headline puts around matched words, removed by marked_offsets
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+HEADLINE_OPTIONS = 'StartSel={}, StopSel={}, HighlightAll=true'.format(
+    HIGHLIGHT_START, HIGHLIGHT_STOP)
+
+
+"""
+highlight_columns(query, mode)
+    the columns giving where the parsed search query matched, read by
+    read_highlights
+
+    They are selected with the rows of the page, so the database reports
+    the matches of the query itself: ts_headline marks the matched words in
+    'fulltext' mode, otherwise strpos finds each phrase ILIKE matched.
+"""
+def highlight_columns(query, mode=SEARCH_MODE):
+    if not query:
+        return []
+    if fulltext_enabled(mode):
+        tsquery = to_tsquery(query)
+        return [func.ts_headline(SEARCH_LANGUAGE, column, tsquery,
+                                 HEADLINE_OPTIONS)
+                for column in (Question.question, Question.answer)]
+
+    position = func.strpos if db.engine.dialect.name == 'postgresql' \
+        else func.instr
+    return [position(func.lower(Question.question), phrase.lower())
+            for phrase in query.phrases]
+
+
+def read_highlights(values, query, mode=SEARCH_MODE):
+    if query and fulltext_enabled(mode):
+        question, answer = values
+        return {'question': marked_offsets(question),
+                'answer': marked_offsets(answer)}
+
+    return {'question': sorted(
+        [position - 1, position - 1 + len(phrase)]
+        for position, phrase in zip(values, query.phrases) if position),
+        'answer': []}
+
+
+def marked_offsets(marked):
+    """Return the [start, end] offsets of the marked words, unmarked."""
+    offsets = []
+    start = (marked or '').find(HIGHLIGHT_START)
+    removed = 0
+    while start != -1:
+        stop = marked.find(HIGHLIGHT_STOP, start)
+        if stop == -1:
+            break
+        offsets.append([start - removed, stop - removed - 1])
+        removed += 2
+        start = marked.find(HIGHLIGHT_START, stop)
+    return offsets
+
+
+def token_offsets(text, tokens):
+    """Return the [start, end] offsets of the words of `text` in `tokens`."""
+    return [[match.start(), match.end()]
+            for match in TOKEN_PATTERN.finditer(text or '')
+            if match.group().lower() in tokens]
+
+
+# Category and difficulty stored by the search index for missing values
+NO_VALUE = -1
+
+
+def facet_value(value):
+    value = category_key(value)
+    return NO_VALUE if value is None else value
+
+
+"""
+Facets
+    numbers of matching questions per category and per difficulty
+"""
+class Facets:
+
+    def __init__(self):
+        self.total = 0
+        self.categories = Counter()
+        self.difficulties = Counter()
+
+    def add(self, category, difficulty, count=1):
+        self.total += count
+        if facet_value(category) != NO_VALUE:
+            self.categories[facet_value(category)] += count
+        if facet_value(difficulty) != NO_VALUE:
+            self.difficulties[facet_value(difficulty)] += count
+
+    def format(self):
+        return {
+            'categories': dict(self.categories),
+            'difficulties': dict(self.difficulties)
+        }
+
+
+"""
+run_search(search_term, offset, limit, count_mode, filters)
+    one page of the questions matching search_term and filters, best first,
+    as (question, highlights) pairs, with the total number of matches and
+    their facets
+
+    In 'memory' mode the index ranks every match, gives their facets and
+    only the rows of the page are fetched; their highlights are the words
+    the tokenizer of the index finds in the search term. Otherwise the page
+    is read with LIMIT/OFFSET along with its highlight_columns, and the
+    facets with one query grouped by category and difficulty, which also
+    gives the exact total. With count_mode 'estimated' the grouped query is
+    skipped: the total is the planner estimate and facets are None.
+
+    Highlights hold the [start, end] character offsets of the matches in
+    the 'question' and 'answer' texts.
+"""
+def run_search(search_term, offset=0, limit=None, count_mode='exact',
+               filters=None, mode=SEARCH_MODE):
+    end = offset + limit if limit is not None else None
+    query = parse_query(search_term)
+    filters = (filters or SearchFilters()).narrowed(query)
+    if memory_enabled(mode):
+        question_ids = search_index.search(query, filters)
+        tokens = {token for phrase in query.phrases
+                  for token in tokenize(phrase)}
+        hits = [(question, {
+            'question': token_offsets(question.question, tokens),
+            'answer': token_offsets(question.answer, tokens)
+        }) for question in fetch_in_order(question_ids[offset:end])]
+        return hits, len(question_ids), search_index.facets(question_ids)
+
+    search_results = search_query(query, filters, mode)
+    page = search_results.offset(offset).limit(limit)
+    columns = highlight_columns(query, mode)
+    if columns:
+        hits = [(row[0], read_highlights(row[1:], query, mode))
+                for row in page.add_columns(*columns)]
+    else:
+        hits = [(question, read_highlights((), query, mode))
+                for question in page]
+    if count_mode == 'estimated':
+        return hits, count_questions(search_results, count_mode), None
+
+    facets = Facets()
+    for category, difficulty, count in search_results.order_by(
+            None).with_entities(
+                Question.category, Question.difficulty,
+                func.count(Question.id)
+            ).group_by(Question.category, Question.difficulty):
+        facets.add(category, difficulty, count)
+    return hits, facets.total, facets
+
+
+def fetch_in_order(question_ids):
+    found = {question.id: question for question in
+             Question.query.filter(Question.id.in_(question_ids))}
+    return [found[question_id] for question_id in question_ids
+            if question_id in found]
+
+
+def question_rows(after_id=None):
+    rows = db.session.query(Question.id, Question.question, Question.answer,
+                            Question.category, Question.difficulty)
+    if after_id is not None:
+        rows = rows.filter(Question.id > after_id)
+    return rows.order_by(Question.id).yield_per(1000)
+
+
+def index_rows(*conditions):
+    """Return the rows of question_rows with their version, for the index."""
+    return db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty, Question.version
+    ).filter(*conditions).order_by(Question.id).yield_per(1000)
+
+
+def document_frequency(layers, token):
+    frequency = 0
+    for index, _ in layers:
+        posting = index.posting(token)
+        if posting is not None:
+            frequency += len(posting[0])
+    return frequency
+
+
+def posting_count(posting, question_id):
+    """Return how many times the question holds the token of `posting`."""
+    if posting is None:
+        return 0
+    ids, counts = posting
+    position = bisect_left(ids, question_id)
+    if position < len(ids) and ids[position] == question_id:
+        return counts[position]
+    return 0
+
+
+"""
+holding(layers, tokens, frequencies, filters, within)
+    {question id: (index, {token: count})} of the questions holding every
+    token
+
+    Without `within`, the posting list of the rarest token is walked and
+    the others only filter it. With `within`, a result of holding, only
+    those questions are looked up.
+"""
+def holding(layers, tokens, frequencies, filters=None, within=None):
+    tokens = sorted(set(tokens), key=frequencies.get)
+    found = {}
+    if within is not None:
+        postings = {index: [index.posting(token) for token in tokens]
+                    for index, _ in layers}
+        for question_id, (index, _) in within.items():
+            counts = [posting_count(posting, question_id)
+                      for posting in postings[index]]
+            if all(counts):
+                found[question_id] = (index, dict(zip(tokens, counts)))
+        return found
+
+    for index, hidden in layers:
+        postings = [index.posting(token) for token in tokens]
+        if any(posting is None for posting in postings):
+            continue
+        matched = {question_id: {tokens[0]: count} for question_id, count
+                   in zip(*postings[0]) if question_id not in hidden and (
+                       not filters or
+                       filters.accepts(*index.attributes(question_id)))}
+        for token, posting in zip(tokens[1:], postings[1:]):
+            for question_id in list(matched):
+                count = posting_count(posting, question_id)
+                if count:
+                    matched[question_id][token] = count
+                else:
+                    del matched[question_id]
+        for question_id, counts in matched.items():
+            found[question_id] = (index, counts)
+    return found
+
+
+"""
+rank(layers, query, document_count, total_length, filters)
+    ids of the questions matching the parsed search query, best BM25 score
+    first
+
+    `layers` is a list of (index, hidden ids) pairs searched together;
+    questions of a layer whose id is hidden are left out, as are those
+    the filters reject. Document frequencies add up over the layers.
+
+    The clauses are evaluated from the most selective one, whose rarest
+    token is walked, and the others only look up the questions left. A
+    phrase matches the questions holding all its words: phrases of several
+    words, and excluded ones, are then checked by confirm_phrases.
+"""
+def rank(layers, query, document_count, total_length, filters=None):
+    query = query.map(index_phrase)
+    frequencies = {token: document_frequency(layers, token)
+                   for phrase in query.phrases + query.excluded
+                   for token in phrase.split()}
+
+    def selectivity(clause):
+        return sum(min(frequencies[token] for token in phrase.split())
+                   for phrase in clause)
+
+    matched = None
+    for clause in sorted(query.clauses, key=selectivity):
+        clause_matched = {}
+        for phrase in clause:
+            for question_id, (index, counts) in holding(
+                    layers, phrase.split(), frequencies, filters,
+                    matched).items():
+                clause_matched.setdefault(
+                    question_id, (index, {}))[1].update(counts)
+        if matched is not None:
+            for question_id, (_, counts) in clause_matched.items():
+                counts.update(matched[question_id][1])
+        matched = clause_matched
+        if not matched:
+            return []
+
+    if matched is None:
+        matched = {question_id: (index, {})
+                   for index, hidden in layers for question_id in index
+                   if question_id not in hidden and (
+                       not filters or
+                       filters.accepts(*index.attributes(question_id)))}
+    for phrase in query.excluded:
+        if ' ' not in phrase:
+            postings = {index: index.posting(phrase) for index, _ in layers}
+            matched = {question_id: match for question_id, match
+                       in matched.items() if not posting_count(
+                           postings[match[0]], question_id)}
+
+    if not query.clauses:
+        return sorted(matched)
+
+    average_length = total_length / max(document_count, 1)
+    idfs = {token: math.log(1 + (
+        max(document_count - frequency, 0) + 0.5) / (frequency + 0.5))
+        for token, frequency in frequencies.items()}
+    scores = {}
+    for question_id, (index, counts) in matched.items():
+        length_ratio = index.length(question_id) / average_length
+        scores[question_id] = sum(
+            idfs[token] * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (
+                1 - BM25_B + BM25_B * length_ratio))
+            for token, frequency in counts.items())
+
+    return sorted(scores, key=lambda question_id: (
+        -scores[question_id], question_id))
+
+
+"""
+confirm_phrases(question_ids, query)
+    the questions whose texts hold the phrases of the parsed search query,
+    in order
+
+    The search index keeps no word positions, so when the query has
+    phrases of several words the texts of the questions the index matched
+    are read in chunks to check them. Other queries are returned as is.
+"""
+def confirm_phrases(question_ids, query):
+    query = query.map(index_phrase)
+    if not any(' ' in phrase for phrase in query.phrases + query.excluded):
+        return question_ids
+
+    texts = {}
+    for start in range(0, len(question_ids), PHRASE_CHUNK_SIZE):
+        for question_id, question, answer in db.session.query(
+                Question.id, Question.question, Question.answer).filter(
+                    Question.id.in_(
+                        question_ids[start:start + PHRASE_CHUNK_SIZE])):
+            texts[question_id] = [' {} '.format(index_phrase(text or ''))
+                                  for text in (question, answer)]
+
+    def holds(question_id, phrase):
+        return any(' {} '.format(phrase) in text
+                   for text in texts[question_id])
+
+    return [question_id for question_id in question_ids
+            if question_id in texts and all(
+                any(holds(question_id, phrase) for phrase in clause)
+                for clause in query.clauses) and not any(
+                holds(question_id, phrase) for phrase in query.excluded)]
+
+
+"""
+InvertedIndex
+    token -> posting list index over the question and answer texts
+
+    Each posting list is a pair of array('i'): the sorted ids of the
+    questions holding the token and how many times they hold it. The
+    tokens of each question are kept too so it can be removed or updated
+    without a rebuild, and its version so a file written from the index
+    can tell the questions changed since.
+"""
+class InvertedIndex:
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.total_length = 0
+
+    @classmethod
+    def build(cls, rows):
+        index = cls()
+        for row in rows:
+            index.add(*row)
+        return index
+
+    @property
+    def document_count(self):
+        return len(self.documents)
+
+    def __contains__(self, question_id):
+        return question_id in self.documents
+
+    def __iter__(self):
+        return iter(sorted(self.documents))
+
+    def posting(self, token):
+        return self.postings.get(token)
+
+    def length(self, question_id):
+        return self.documents[question_id][0]
+
+    def attributes(self, question_id):
+        """Return the category and difficulty of the question."""
+        return self.documents[question_id][2:4]
+
+    def version(self, question_id):
+        return self.documents[question_id][4]
+
+    def add(self, question_id, question, answer, category, difficulty,
+            version=1):
+        tokens = tokenize(question) + tokenize(answer)
+        frequencies = Counter(tokens)
+        for token, frequency in frequencies.items():
+            ids, counts = self.postings.setdefault(
+                token, (array('i'), array('i')))
+            if not ids or ids[-1] < question_id:
+                ids.append(question_id)
+                counts.append(frequency)
+            else:
+                position = bisect_left(ids, question_id)
+                ids.insert(position, question_id)
+                counts.insert(position, frequency)
+        self.documents[question_id] = (
+            len(tokens), tuple(frequencies), facet_value(category),
+            facet_value(difficulty), version)
+        self.total_length += len(tokens)
+
+    def remove(self, question_id):
+        length, tokens = self.documents.pop(question_id, (0, ()))[:2]
+        for token in tokens:
+            ids, counts = self.postings[token]
+            position = bisect_left(ids, question_id)
+            if position < len(ids) and ids[position] == question_id:
+                del ids[position]
+                del counts[position]
+            if not ids:
+                del self.postings[token]
+        self.total_length -= length
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.postings) + sum(
+            sys.getsizeof(ids) + sys.getsizeof(counts)
+            for ids, counts in self.postings.values()
+        ) + sys.getsizeof(self.documents) + sum(
+            sys.getsizeof(document[1]) for document in
+            self.documents.values())
+
+
+"""
+Search index files
+
+    A header (magic, numbers of questions, tokens and postings, total
+    token count) is followed by int32 arrays: the sorted question ids,
+    their token counts, categories, difficulties and versions, the offsets
+    of each
+    token in the vocabulary and of its posting list, then the ids and
+    counts of all posting lists. The UTF-8 vocabulary, sorted, comes last.
+"""
+INDEX_MAGIC = b'TRIVIDX3'
+INDEX_HEADER = struct.Struct('<8sIIIQ')
+
+
+def write_index(index, path):
+    """Write `index` to `path`, replacing any previous file atomically."""
+    tokens = sorted(index.postings)
+    question_ids = array('i', sorted(index.documents))
+    lengths = array('i', (index.length(question_id)
+                          for question_id in question_ids))
+    categories = array('i', (index.attributes(question_id)[0]
+                             for question_id in question_ids))
+    difficulties = array('i', (index.attributes(question_id)[1]
+                               for question_id in question_ids))
+    versions = array('i', (index.version(question_id)
+                           for question_id in question_ids))
+    vocabulary = bytearray()
+    token_offsets = array('i', [0])
+    posting_offsets = array('i', [0])
+    posting_ids = array('i')
+    posting_counts = array('i')
+    for token in tokens:
+        vocabulary += token.encode()
+        token_offsets.append(len(vocabulary))
+        ids, counts = index.postings[token]
+        posting_ids.extend(ids)
+        posting_counts.extend(counts)
+        posting_offsets.append(len(posting_ids))
+
+    if sys.byteorder != 'little':
+        for values in (question_ids, lengths, categories, difficulties,
+                       versions, token_offsets, posting_offsets, posting_ids,
+                       posting_counts):
+            values.byteswap()
+
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as index_file:
+        index_file.write(INDEX_HEADER.pack(
+            INDEX_MAGIC, len(question_ids), len(tokens), len(posting_ids),
+            index.total_length))
+        for values in (question_ids, lengths, categories, difficulties,
+                       versions, token_offsets, posting_offsets, posting_ids,
+                       posting_counts):
+            values.tofile(index_file)
+        index_file.write(vocabulary)
+    os.replace(temporary_path, path)
+
+
+"""
+MappedIndex
+    read-only search index memory-mapped from a file written by
+    write_index
+
+    Nothing is copied into the process: the arrays are views on the
+    mapping, so every worker shares the same pages of the OS cache.
+"""
+class MappedIndex:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self._mapping = mmap.mmap(
+                index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, documents, tokens, postings, self.total_length = \
+            INDEX_HEADER.unpack_from(self._mapping)
+        if magic != INDEX_MAGIC or sys.byteorder != 'little':
+            raise ValueError('{} is not a search index file'.format(path))
+
+        view = memoryview(self._mapping)
+        offset = INDEX_HEADER.size
+        arrays = []
+        for size in (documents, documents, documents, documents, documents,
+                     tokens + 1, tokens + 1, postings, postings):
+            arrays.append(view[offset:offset + 4 * size].cast('i'))
+            offset += 4 * size
+        (self.ids, self._lengths, self._categories, self._difficulties,
+         self.versions, self._token_offsets, self._posting_offsets,
+         self._posting_ids, self._posting_counts) = arrays
+        self._vocabulary = view[offset:]
+        self.token_count = tokens
+
+    @property
+    def document_count(self):
+        return len(self.ids)
+
+    @property
+    def max_id(self):
+        return self.ids[-1] if len(self.ids) else 0
+
+    @property
+    def nbytes(self):
+        return len(self._mapping)
+
+    def __contains__(self, question_id):
+        position = bisect_left(self.ids, question_id)
+        return position < len(self.ids) and self.ids[position] == question_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def _token(self, position):
+        return self._vocabulary[self._token_offsets[position]:
+                                self._token_offsets[position + 1]].tobytes()
+
+    def posting(self, token):
+        token = token.encode()
+        low, high = 0, self.token_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._token(middle) < token:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.token_count or self._token(low) != token:
+            return None
+        start = self._posting_offsets[low]
+        end = self._posting_offsets[low + 1]
+        return self._posting_ids[start:end], self._posting_counts[start:end]
+
+    def length(self, question_id):
+        return self._lengths[bisect_left(self.ids, question_id)]
+
+    def attributes(self, question_id):
+        """Return the category and difficulty of the question."""
+        position = bisect_left(self.ids, question_id)
+        return self._categories[position], self._difficulties[position]
+
+    def version(self, question_id):
+        return self.versions[bisect_left(self.ids, question_id)]
+
+
+"""
+snapshot_changes(snapshot)
+    the ids of the snapshot to hide, those deleted or changed since the
+    file was written, and the sorted ids to index in memory, those changed
+    or missing from the file, among the questions up to its last id
+
+    The (id, version) pairs of the database and the ids of the file are
+    both walked in id order, so nothing of the size of the bank is held.
+"""
+def snapshot_changes(snapshot):
+    hidden = set()
+    changed = []
+    position = 0
+    ids = snapshot.ids
+    for question_id, version in db.session.query(
+            Question.id, Question.version).filter(
+                Question.id <= snapshot.max_id
+            ).order_by(Question.id).yield_per(10000):
+        while position < len(ids) and ids[position] < question_id:
+            hidden.add(ids[position])
+            position += 1
+        if position < len(ids) and ids[position] == question_id:
+            if snapshot.versions[position] != version:
+                hidden.add(question_id)
+                changed.append(question_id)
+            position += 1
+        else:
+            changed.append(question_id)
+    hidden.update(ids[position:])
+    return hidden, changed
+
+
+"""
+SearchIndex
+    the index searched by the 'memory' search mode
+
+    When SEARCH_INDEX_PATH holds a file built by `flask build-search-index`
+    it is memory-mapped, and only the questions added or changed since are
+    indexed in memory on top of it; their entries in the file are hidden.
+    Changed questions are those whose version differs from the one in the
+    file, so the edits of other processes are caught too. Without the file
+    the whole bank is indexed in memory.
+
+    Every `ttl` seconds the index is reloaded to catch up with the writes
+    of other workers. The reload reads the database in a background thread
+    while searches go on with the current index; the writes of this
+    process made meanwhile are replayed on the new one before it replaces
+    the current one. Only the first build makes a search wait.
+"""
+class SearchIndex:
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL, path=SEARCH_INDEX_PATH):
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self._snapshot = None
+        self._delta = None
+        self._hidden = set()
+        self._hidden_length = 0
+        self._events = None
+        self._refreshing = False
+        self._built_at = 0.0
+        self._rebuild_seconds = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._delta = None
+            self._hidden = set()
+            self._hidden_length = 0
+
+    def rebuild(self):
+        """Load the index again from the file and the database.
+
+        The database is read without holding the lock of the index, which
+        is only taken to swap in the new index.
+        """
+        with self._rebuild_lock:
+            started = time.monotonic()
+            with self._lock:
+                self._events = []
+            try:
+                snapshot, delta, hidden = self._load()
+            except BaseException:
+                with self._lock:
+                    self._events = None
+                raise
+
+            with self._lock:
+                events, self._events = self._events, None
+                self._snapshot = snapshot
+                self._delta = delta
+                self._hidden = set()
+                self._hidden_length = 0
+                for question_id in hidden:
+                    self._hide(question_id)
+                for event, question in events:
+                    self._apply(event, question)
+                self._built_at = time.monotonic()
+                self._rebuild_seconds = self._built_at - started
+
+    def _load(self):
+        """Return the snapshot, the delta and the snapshot ids to hide."""
+        snapshot = None
+        if self.path and os.path.exists(self.path):
+            try:
+                snapshot = MappedIndex(self.path)
+            except ValueError:
+                # e.g. written by an older version, index in memory instead
+                print(sys.exc_info())
+        if snapshot is None:
+            return None, InvertedIndex.build(index_rows()), set()
+
+        delta = InvertedIndex.build(
+            index_rows(Question.id > snapshot.max_id))
+        hidden, changed = snapshot_changes(snapshot)
+        for start in range(0, len(changed), REINDEX_CHUNK_SIZE):
+            for row in index_rows(Question.id.in_(
+                    changed[start:start + REINDEX_CHUNK_SIZE])):
+                delta.add(*row)
+        return snapshot, delta, hidden
+
+    def _refresh(self, app):
+        """Rebuild in a background thread, unless one is running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                print(sys.exc_info())
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _ensure_built(self):
+        if self._delta is None:
+            self.rebuild()
+        elif time.monotonic() - self._built_at >= self.ttl:
+            self._refresh(current_app._get_current_object())
+
+    def _hide(self, question_id):
+        if question_id not in self._hidden:
+            self._hidden.add(question_id)
+            self._hidden_length += self._snapshot.length(question_id)
+
+    def _apply(self, event, question):
+        if self._snapshot is not None and question['id'] in self._snapshot:
+            self._hide(question['id'])
+        self._delta.remove(question['id'])
+        if event != 'delete':
+            self._delta.add(question['id'], question['question'],
+                            question['answer'], question['category'],
+                            question['difficulty'],
+                            question.get('version', 1))
+
+    def on_question_event(self, event, question):
+        with self._lock:
+            if self._events is not None:
+                self._events.append((event, question))
+            if self._delta is not None:
+                self._apply(event, question)
+
+    def search(self, query, filters=None):
+        """Return the ids of the questions matching `query`, best first."""
+        self._ensure_built()
+        with self._lock:
+            layers = [(self._delta, ())]
+            document_count = self._delta.document_count
+            total_length = self._delta.total_length
+            if self._snapshot is not None:
+                layers.append((self._snapshot, self._hidden))
+                document_count += self._snapshot.document_count - \
+                    len(self._hidden)
+                total_length += self._snapshot.total_length - \
+                    self._hidden_length
+            question_ids = rank(layers, query, document_count,
+                                total_length, filters)
+        return confirm_phrases(question_ids, query)
+
+    def facets(self, question_ids):
+        """Return the Facets of `question_ids`, which the index holds."""
+        facets = Facets()
+        with self._lock:
+            for question_id in question_ids:
+                if question_id in self._delta:
+                    facets.add(*self._delta.attributes(question_id))
+                elif (self._snapshot is not None and
+                        question_id in self._snapshot):
+                    facets.add(*self._snapshot.attributes(question_id))
+        return facets
+
+    def stats(self):
+        with self._lock:
+            delta = self._delta or InvertedIndex()
+            snapshot = self._snapshot
+            return {
+                'built': self._delta is not None,
+                'questions': delta.document_count + (
+                    snapshot.document_count - len(self._hidden)
+                    if snapshot is not None else 0),
+                'tokens': len(delta.postings),
+                'postings': sum(len(ids) for ids, _ in
+                                delta.postings.values()),
+                'bytes': delta.nbytes,
+                'snapshot': {
+                    'path': snapshot.path,
+                    'questions': snapshot.document_count,
+                    'tokens': snapshot.token_count,
+                    'hidden': len(self._hidden),
+                    'bytes': snapshot.nbytes,
+                } if snapshot is not None else None,
+                'rebuild_seconds': round(self._rebuild_seconds, 6),
+                'age_seconds': round(time.monotonic() - self._built_at, 3)
+                if self._delta is not None else None,
+                'rebuilding': self._refreshing,
+            }
+
+
+search_index = SearchIndex()
@@ -0,0 +1,143 @@
+import random
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import func
+
+from models import db, SearchLog
+from settings import SEARCH_LOG_SAMPLE_RATE, SEARCH_LOG_BATCH_SIZE, \
+    SEARCH_WARM_QUERIES
+from .cache import search_page
+from .search import SearchFilters, normalize_search_term
+
+# Searches kept in memory, in batches, while the log cannot be written
+LOG_BUFFER_BATCHES = 10
+# Seconds before writing the log again after a failure
+FLUSH_RETRY_SECONDS = 60
+# Only the searches of the last days are replayed on startup
+WARM_WINDOW = timedelta(days=7)
+
+
+"""
+QueryLog
+    sampled first-page searches, held in a ring buffer and written to the
+    search_log table in batches
+
+    Search terms are logged normalized, so the terms sharing a cache entry
+    add up. While the table cannot be written the ring keeps the latest
+    searches and drops the oldest ones.
+"""
+class QueryLog:
+
+    def __init__(self, sample_rate=SEARCH_LOG_SAMPLE_RATE,
+                 batch_size=SEARCH_LOG_BATCH_SIZE):
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._buffer = deque(maxlen=max(batch_size, 1) * LOG_BUFFER_BATCHES)
+        self._failed_at = None
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, search_term, limit, count_mode, filters, autocorrect):
+        if random.random() >= self.sample_rate:
+            return
+        entry = {
+            'search_term': normalize_search_term(search_term),
+            'page_limit': limit,
+            'count_mode': count_mode,
+            'category': filters.category,
+            'difficulty_min': filters.difficulty_min,
+            'difficulty_max': filters.difficulty_max,
+            'autocorrect': bool(autocorrect),
+            'searched_at': datetime.utcnow(),
+        }
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(entry)
+            self.recorded += 1
+            full = len(self._buffer) >= self.batch_size and (
+                self._failed_at is None or
+                time.monotonic() - self._failed_at >= FLUSH_RETRY_SECONDS)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered searches with one executemany."""
+        with self._lock:
+            entries = list(self._buffer)
+            self._buffer.clear()
+        if not entries:
+            return 0
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(SearchLog.__table__.insert(), entries)
+        except Exception:
+            print(sys.exc_info())
+            with self._lock:
+                kept = deque(entries + list(self._buffer),
+                             maxlen=self._buffer.maxlen)
+                self.dropped += len(entries) + len(self._buffer) - len(kept)
+                self._buffer = kept
+                self._failed_at = time.monotonic()
+            return 0
+
+        with self._lock:
+            self.written += len(entries)
+            self._failed_at = None
+        return len(entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'buffered': len(self._buffer),
+                'recorded': self.recorded,
+                'written': self.written,
+                'dropped': self.dropped,
+            }
+
+
+search_log = QueryLog()
+
+
+def top_searches(limit=SEARCH_WARM_QUERIES):
+    """Return the most logged searches of the last WARM_WINDOW."""
+    columns = (SearchLog.search_term, SearchLog.page_limit,
+               SearchLog.count_mode, SearchLog.category,
+               SearchLog.difficulty_min, SearchLog.difficulty_max,
+               SearchLog.autocorrect)
+    return db.session.query(*columns).filter(
+        SearchLog.searched_at >= datetime.utcnow() - WARM_WINDOW
+    ).group_by(*columns).order_by(
+        func.count(SearchLog.id).desc()
+    ).limit(limit).all()
+
+
+"""
+warm_search_cache(limit)
+    runs the `limit` most logged searches so their first pages are in the
+    search cache, and returns how many were cached
+"""
+def warm_search_cache(limit=SEARCH_WARM_QUERIES):
+    if limit <= 0:
+        return 0
+
+    warmed = 0
+    for (search_term, page_limit, count_mode, category, difficulty_min,
+         difficulty_max, autocorrect) in top_searches(limit):
+        try:
+            search_page(search_term, 0, page_limit, count_mode,
+                        SearchFilters(category, difficulty_min,
+                                      difficulty_max), autocorrect)
+            warmed += 1
+        except Exception:
+            # e.g. a category removed since the search was logged
+            print(sys.exc_info())
+            db.session.rollback()
+    return warmed
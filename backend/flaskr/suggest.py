@@ -0,0 +1,291 @@
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from flask import current_app
+
+from models import db, Question
+from settings import SEARCH_INDEX_TTL
+from .query import parse_query
+from .search import index_phrase, tokenize
+
+# Suggestions precomputed for every prefix up to this length
+CACHED_PREFIX_LENGTH = 3
+SUGGESTION_LIMIT = 10
+
+# Spelling corrections are at most MAX_EDIT_DISTANCE edits away, fewer for
+# short words (see max_edit_distance). Terms are indexed by their variants
+# with up to TERM_DELETES letters deleted among the first
+# DELETE_PREFIX_LENGTH ones, misspelt words with up to MAX_EDIT_DISTANCE
+# deletions, which keeps the index small at the cost of missing some words
+# two substitutions away.
+MAX_EDIT_DISTANCE = 2
+TERM_DELETES = 1
+DELETE_PREFIX_LENGTH = 7
+
+
+def deletes(term, distance):
+    """Return the variants of `term` with up to `distance` letters deleted."""
+    variants = {term[:DELETE_PREFIX_LENGTH]}
+    edges = set(variants)
+    for _ in range(distance):
+        edges = {variant[:position] + variant[position + 1:]
+                 for variant in edges for position in range(len(variant))}
+        variants |= edges
+    return variants
+
+
+def max_edit_distance(word):
+    """Return the edits allowed to correct `word`.
+
+    Short words are mostly valid words or abbreviations missing from the
+    questions, and words with digits are numbers or codes, so they are
+    left alone; up to five letters one typo is allowed.
+    """
+    if len(word) <= 2 or any(character.isdigit() for character in word):
+        return 0
+    if len(word) <= 5:
+        return 1
+    return MAX_EDIT_DISTANCE
+
+
+def edit_distance(source, target, limit=MAX_EDIT_DISTANCE):
+    """Return the optimal string alignment distance, or limit + 1 above it."""
+    if abs(len(source) - len(target)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = source[i - 1] != target[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + cost)
+            if (i > 1 and j > 1 and source[i - 1] == target[j - 2] and
+                    source[i - 2] == target[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+"""
+SuggestionIndex
+    sorted vocabulary of the question texts for prefix completion and
+    spelling correction
+
+    Terms are ranked by the number of questions using them. The best
+    SUGGESTION_LIMIT terms of every prefix up to CACHED_PREFIX_LENGTH
+    characters are precomputed, when they would otherwise mean scanning a
+    large part of the vocabulary; longer prefixes scan their short range
+    of the sorted terms. Corrections look up the deletion variants of a
+    misspelt word in a SymSpell-style dictionary of the terms' variants.
+
+    Like SearchIndex, it is reloaded every `ttl` seconds by a background
+    thread, and the writes of this process made during a reload are
+    replayed on the new vocabulary before it replaces the current one.
+"""
+class SuggestionIndex:
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._terms = None
+        self._frequencies = Counter()
+        self._documents = {}
+        self._top = {}
+        self._deletes = {}
+        self._events = None
+        self._refreshing = False
+        self._built_at = 0.0
+        self._rebuild_seconds = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._terms = None
+            self._frequencies = Counter()
+            self._documents = {}
+            self._top = {}
+            self._deletes = {}
+
+    def rebuild(self):
+        """Read the questions again, holding the lock only to swap them in."""
+        with self._rebuild_lock:
+            started = time.monotonic()
+            with self._lock:
+                self._events = []
+            try:
+                frequencies, documents, top, term_deletes = self._load()
+            except BaseException:
+                with self._lock:
+                    self._events = None
+                raise
+
+            with self._lock:
+                events, self._events = self._events, None
+                self._terms = sorted(frequencies)
+                self._frequencies = frequencies
+                self._documents = documents
+                self._top = top
+                self._deletes = term_deletes
+                for event, question in events:
+                    self._apply(event, question)
+                self._built_at = time.monotonic()
+                self._rebuild_seconds = self._built_at - started
+
+    def _load(self):
+        frequencies = Counter()
+        documents = {}
+        rows = db.session.query(Question.id, Question.question).yield_per(1000)
+        for question_id, question in rows:
+            documents[question_id] = tuple(set(tokenize(question)))
+            frequencies.update(documents[question_id])
+
+        by_prefix = {}
+        for term, frequency in frequencies.items():
+            for length in range(1, min(len(term), CACHED_PREFIX_LENGTH) + 1):
+                by_prefix.setdefault(term[:length], []).append(term)
+        top = {prefix: self._best(terms, frequencies)
+               for prefix, terms in by_prefix.items()}
+        term_deletes = {}
+        for term in frequencies:
+            for variant in deletes(term, TERM_DELETES):
+                term_deletes.setdefault(variant, []).append(term)
+        return frequencies, documents, top, term_deletes
+
+    def _refresh(self, app):
+        """Rebuild in a background thread, unless one is running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                print(sys.exc_info())
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _ensure_built(self):
+        if self._terms is None:
+            self.rebuild()
+        elif time.monotonic() - self._built_at >= self.ttl:
+            self._refresh(current_app._get_current_object())
+
+    def _best(self, terms, frequencies):
+        return sorted(terms, key=lambda term: (-frequencies[term], term))[
+            :SUGGESTION_LIMIT]
+
+    def _range(self, prefix):
+        start = bisect_left(self._terms, prefix)
+        end = start
+        while end < len(self._terms) and self._terms[end].startswith(prefix):
+            end += 1
+        return self._terms[start:end]
+
+    def complete(self, prefix, limit=SUGGESTION_LIMIT):
+        """Return up to `limit` terms starting with `prefix`, most used first."""
+        self._ensure_built()
+        with self._lock:
+            if len(prefix) <= CACHED_PREFIX_LENGTH:
+                top = self._top.get(prefix)
+                if top is None and prefix in self._top:
+                    top = self._top[prefix] = self._best(
+                        self._range(prefix), self._frequencies)
+                return list(top or [])[:limit]
+            return self._best(self._range(prefix), self._frequencies)[:limit]
+
+    def correct(self, word):
+        """Return the most used term closest to `word`, or None."""
+        self._ensure_built()
+        with self._lock:
+            if word in self._frequencies:
+                return word
+            distance = max_edit_distance(word)
+            if not distance:
+                return None
+            candidates = {term for variant in deletes(word, distance)
+                          for term in self._deletes.get(variant, ())}
+            best = None
+            for term in candidates:
+                rank = (edit_distance(word, term, distance),
+                        -self._frequencies[term], term)
+                if rank[0] <= distance and (best is None or rank < best):
+                    best = rank
+            return best[2] if best else None
+
+    def _count(self, term, change):
+        self._frequencies[term] += change
+        if self._frequencies[term] <= 0:
+            del self._frequencies[term]
+            del self._terms[bisect_left(self._terms, term)]
+            for variant in deletes(term, TERM_DELETES):
+                self._deletes[variant].remove(term)
+                if not self._deletes[variant]:
+                    del self._deletes[variant]
+        elif change > 0 and self._frequencies[term] == change:
+            insort(self._terms, term)
+            for variant in deletes(term, TERM_DELETES):
+                self._deletes.setdefault(variant, []).append(term)
+        # Recomputed on the next completion of these prefixes
+        for length in range(1, min(len(term), CACHED_PREFIX_LENGTH) + 1):
+            self._top[term[:length]] = None
+
+    def _apply(self, event, question):
+        for term in self._documents.pop(question['id'], ()):
+            self._count(term, -1)
+        if event != 'delete':
+            terms = tuple(set(tokenize(question['question'])))
+            self._documents[question['id']] = terms
+            for term in terms:
+                self._count(term, 1)
+
+    def on_question_event(self, event, question):
+        with self._lock:
+            if self._events is not None:
+                self._events.append((event, question))
+            if self._terms is not None:
+                self._apply(event, question)
+
+
+suggestion_index = SuggestionIndex()
+
+
+"""
+suggest(prefix, limit)
+    completes the last word of `prefix` with the most used terms of the
+    questions, keeping the words typed before it
+"""
+def suggest(prefix, limit=SUGGESTION_LIMIT):
+    words = tokenize(prefix)
+    if not words or not prefix[-1:].isalnum():
+        return []
+    head = ' '.join(words[:-1])
+    return [(head + ' ' + term).lstrip()
+            for term in suggestion_index.complete(words[-1], limit)]
+
+
+"""
+did_you_mean(search_term)
+    the search term with every misspelt word replaced by its closest term
+    of the questions, or None when there is nothing to correct
+
+    Phrases, exclusions, `OR` and the `category:` prefix of the term are
+    kept.
+"""
+def did_you_mean(search_term):
+    query = parse_query(search_term).map(index_phrase)
+    corrected = query.map(lambda phrase: ' '.join(
+        suggestion_index.correct(word) or word for word in phrase.split()))
+    if str(corrected) == str(query):
+        return None
+    return str(corrected)
@@ -1,7 +1,12 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+import sys
+import threading
+from contextlib import contextmanager
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Float, \
+    Index, create_engine, exc, inspect, text
 from flask_sqlalchemy import SQLAlchemy
-from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+from settings import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, \
+    SEARCH_MODE, SEARCH_LANGUAGE
 import json
 
 database_path = 'postgresql://{}:{}@{}:{}/{}'.format(
@@ -9,6 +14,77 @@ database_path = 'postgresql://{}:{}@{}:{}/{}'.format(
 
 db = SQLAlchemy()
 
+"""
+question_listeners
+    callables run as listener(event, question) once a question change is
+    committed; event is 'insert', 'update' or 'delete' and question is the
+    formatted row, captured before the commit expires the instance
+
+    The change is already committed when they run, so an exception of a
+    listener is printed and the other listeners still run; it never
+    reaches the writer.
+"""
+question_listeners = []
+
+
+def on_question_change(listener):
+    if listener not in question_listeners:
+        question_listeners.append(listener)
+
+
+def notify_question_listeners(event, question):
+    for listener in question_listeners:
+        try:
+            listener(event, question)
+        except Exception:
+            print(sys.exc_info())
+
+
+"""
+question_batch()
+    context manager grouping the question writes made inside it into one
+    transaction
+
+        with question_batch():
+            for question in questions:
+                question.insert()
+
+    Question.insert, update and delete only flush or stage their change
+    within a batch; the outermost batch commits once on exit and then
+    notifies the listeners of every change, in order. An exception raised
+    before the commit succeeds rolls the whole batch back and notifies
+    nothing. Nested batches join the
+    outermost one. Batches are tracked per thread, like the session.
+"""
+_batches = threading.local()
+
+
+@contextmanager
+def question_batch():
+    pending = getattr(_batches, 'pending', None)
+    if pending is not None:
+        yield
+        return
+
+    _batches.pending = pending = []
+    try:
+        yield
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        _batches.pending = None
+
+    for event, question in pending:
+        notify_question_listeners(event, question)
+
+
+def record_question_change(event, question):
+    """Queue a change for the listeners once the current batch commits."""
+    _batches.pending.append((event, question))
+
+
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -19,6 +95,92 @@ def setup_db(app, database_path=database_path):
     db.app = app
     db.init_app(app)
     db.create_all()
+    setup_columns()
+    setup_indexes()
+
+"""
+setup_columns()
+    adds the columns added to the Question model since the questions table
+    was created: the `version` counter of optimistic concurrency
+"""
+def setup_columns():
+    columns = {column['name'] for column in
+               inspect(db.engine).get_columns('questions')}
+    if 'version' in columns:
+        return
+
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                'ALTER TABLE questions '
+                'ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+    except exc.DBAPIError:
+        print(sys.exc_info())
+
+"""
+setup_indexes(mode)
+    adds the indexes that queries rely on to an existing questions table:
+    the (category, difficulty) index of filtered searches, counts and
+    quizzes, then what the search mode needs on PostgreSQL
+
+    The (category, difficulty) index is created in a transaction of its
+    own, so the optional search DDL failing cannot roll it back.
+"""
+def setup_indexes(mode=SEARCH_MODE):
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                """CREATE INDEX IF NOT EXISTS questions_category_difficulty_idx
+                ON questions (category, difficulty)"""))
+    except exc.DBAPIError:
+        print('questions_category_difficulty_idx could not be created, '
+              'filtered queries will scan the questions table')
+        print(sys.exc_info())
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+    try:
+        with db.engine.begin() as connection:
+            for statement in search_index_statements(mode):
+                connection.execute(text(statement))
+    except exc.DBAPIError:
+        # e.g. the database user may not create extensions
+        print(sys.exc_info())
+
+
+"""
+search_index_statements(mode)
+    the pg_trgm extension and a trigram GIN index on question for
+    'trigram', a full-text search column and its GIN index for 'fulltext'
+"""
+def search_index_statements(mode=SEARCH_MODE):
+    if mode == 'trigram':
+        if not trigram_available():
+            print('pg_trgm is not available, searches will not be indexed')
+            return []
+        return [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            """CREATE INDEX IF NOT EXISTS questions_question_trgm_idx
+            ON questions USING GIN (question gin_trgm_ops)""",
+        ]
+    if mode == 'fulltext':
+        return [
+            """ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector
+            tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('{0}', coalesce(question, '')), 'A') ||
+                setweight(to_tsvector('{0}', coalesce(answer, '')), 'B')
+            ) STORED""".format(SEARCH_LANGUAGE),
+            """CREATE INDEX IF NOT EXISTS questions_search_vector_idx
+            ON questions USING GIN (search_vector)""",
+        ]
+    return []
+
+
+def trigram_available():
+    with db.engine.connect() as connection:
+        return connection.execute(text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        )).scalar() is not None
 
 """
 Question
@@ -26,12 +188,19 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('questions_category_difficulty_idx', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
     category = Column(String)
     difficulty = Column(Integer)
+    # Incremented by every update, which the ORM makes conditional on it
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -40,15 +209,19 @@ class Question(db.Model):
         self.difficulty = difficulty
 
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        with question_batch():
+            db.session.add(self)
+            db.session.flush()
+            record_question_change('insert', self.format())
 
     def update(self):
-        db.session.commit()
+        with question_batch():
+            record_question_change('update', self.format())
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        with question_batch():
+            record_question_change('delete', self.format())
+            db.session.delete(self)
 
     def format(self):
         return {
@@ -56,7 +229,8 @@ class Question(db.Model):
             'question': self.question,
             'answer': self.answer,
             'category': self.category,
-            'difficulty': self.difficulty
+            'difficulty': self.difficulty,
+            'version': self.version
             }
 
 """
@@ -77,3 +251,34 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+"""
+RelatedQuestion
+    one of the most similar questions of a question, written by
+    `flask build-related-questions`
+
+"""
+class RelatedQuestion(db.Model):
+    __tablename__ = 'related_questions'
+
+    question_id = Column(Integer, primary_key=True)
+    related_id = Column(Integer, primary_key=True)
+    score = Column(Float, nullable=False)
+
+"""
+SearchLog
+    a sampled first-page search, read on startup to warm the search cache
+
+"""
+class SearchLog(db.Model):
+    __tablename__ = 'search_log'
+
+    id = Column(Integer, primary_key=True)
+    search_term = Column(String, nullable=False)
+    page_limit = Column(Integer, nullable=False)
+    count_mode = Column(String, nullable=False)
+    category = Column(Integer)
+    difficulty_min = Column(Integer)
+    difficulty_max = Column(Integer)
+    autocorrect = Column(Boolean, nullable=False, default=False)
+    searched_at = Column(DateTime, nullable=False, index=True)
@@ -9,3 +9,40 @@ DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 DB_HOST = os.environ.get('DB_HOST')
 DB_PORT = os.environ.get('DB_PORT')
+
+# Signs quiz tokens, every worker must share it
+SECRET_KEY = os.environ.get('SECRET_KEY')
+
+# Seconds before in-process question counts are reloaded from the database
+COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 60))
+
+# Seconds before the in-process quiz question index is rebuilt
+QUIZ_INDEX_TTL = int(os.environ.get('QUIZ_INDEX_TTL', 300))
+
+# Idle seconds and total bytes allowed for server-side quiz sessions
+QUIZ_SESSION_TTL = int(os.environ.get('QUIZ_SESSION_TTL', 3600))
+QUIZ_SESSION_MAX_BYTES = int(
+    os.environ.get('QUIZ_SESSION_MAX_BYTES', 64 * 1024 * 1024))
+
+# How /questions/search matches questions: 'ilike', 'trigram' (ILIKE
+# backed by a pg_trgm index), 'fulltext' (PostgreSQL 12 or later) or
+# 'memory' (BM25 over an inverted index kept in each worker). Databases
+# other than PostgreSQL use 'ilike' in place of 'trigram' and 'fulltext'.
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'ilike')
+SEARCH_LANGUAGE = os.environ.get('SEARCH_LANGUAGE', 'english')
+
+# Seconds before the in-memory search index is rebuilt
+SEARCH_INDEX_TTL = int(os.environ.get('SEARCH_INDEX_TTL', 600))
+# File written by `flask build-search-index` and memory-mapped by workers
+SEARCH_INDEX_PATH = os.environ.get(
+    'SEARCH_INDEX_PATH', os.path.join(BASEDIR, 'search_index.bin'))
+
+# Search results cached per worker, and for how many seconds
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1024))
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 60))
+
+# Share of first-page searches logged, how many are written at once, and
+# how many of the most logged searches are cached on startup
+SEARCH_LOG_SAMPLE_RATE = float(os.environ.get('SEARCH_LOG_SAMPLE_RATE', 0.1))
+SEARCH_LOG_BATCH_SIZE = int(os.environ.get('SEARCH_LOG_BATCH_SIZE', 100))
+SEARCH_WARM_QUERIES = int(os.environ.get('SEARCH_WARM_QUERIES', 50))
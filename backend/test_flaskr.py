@@ -1,10 +1,24 @@
 import os
+import tempfile
 import unittest
+from unittest import mock
 import json
 import pytest
 from flask_sqlalchemy import SQLAlchemy
 from flaskr import create_app
-from models import setup_db
+from models import setup_db, setup_indexes, on_question_change, \
+    question_batch, Question, SearchLog
+from flaskr.bulk import update_question
+from flaskr.cache import search_cache, search_page
+from flaskr.search_log import QueryLog, top_searches, warm_search_cache
+from flaskr.query import parse_query
+from flaskr.related import build_related_questions
+from flaskr.counts import category_key
+from flaskr.quiz import QuestionIdIndex
+from flaskr.suggest import SuggestionIndex
+from flaskr.search import run_search, marked_offsets, search_index, \
+    index_rows, write_index, InvertedIndex, MappedIndex, SearchIndex, \
+    SearchFilters, tokenize
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -106,6 +120,27 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_retrieve_questions_with_cursor(self):
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        res = self.client().get(
+            '/questions?cursor={}'.format(first_page['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertGreater(data['questions'][0]['id'],
+                           first_page['questions'][-1]['id'])
+
+    def test_400_sent_requesting_questions_with_invalid_cursor(self):
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_create_question(self):
         res = self.client().post('/questions', json=self.new_question)
         data = json.loads(res.data)
@@ -114,6 +149,207 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['created'], 175)
 
+    def test_create_questions_in_bulk(self):
+        res = self.client().post('/questions/bulk', json={'questions': [
+            self.new_question,
+            {'question': 'Which row has no answer?', 'category': 1,
+             'difficulty': 1},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['errors'], [{'row': 2,
+                                           'error': 'missing answer'}])
+
+    def test_create_questions_in_bulk_reports_rows_database_rejects(self):
+        res = self.client().post('/questions/bulk', json={'questions': [
+            self.new_question,
+            dict(self.new_question, difficulty=2 ** 70),
+            self.new_question,
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['row'], 2)
+        self.assertTrue(data['errors'][0]['error'].startswith(
+            'rejected by the database'))
+
+    def test_create_questions_despite_failing_listener(self):
+        def failing_listener(event, question):
+            raise RuntimeError('listener failed')
+
+        events = []
+        question = dict(self.new_question,
+                        question='Which listener raised an exception?')
+        with mock.patch('models.question_listeners',
+                        [failing_listener,
+                         lambda event, question: events.append(event)]):
+            res = self.client().post('/questions/bulk', json={
+                'questions': [question, question]})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['created'], 2)
+            self.assertEqual(data['failed'], 0)
+
+            res = self.client().post('/questions', json=question)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['success'], True)
+
+        self.assertEqual(events, ['insert'] * 3)
+        with self.app.app_context():
+            self.assertEqual(Question.query.filter(
+                Question.question == question['question']).count(), 3)
+
+    def test_400_sent_creating_questions_in_bulk_without_list(self):
+        res = self.client().post('/questions/bulk', json={'questions': {}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_sent_creating_questions_in_bulk_from_json_list(self):
+        res = self.client().post('/questions/bulk', json=[self.new_question])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_export_questions_as_csv(self):
+        res = self.client().get('/questions/export?format=csv')
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertTrue(lines[1:])
+
+    def test_400_sent_exporting_questions_in_unknown_format(self):
+        res = self.client().get('/questions/export?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_question_batch_rolls_back_on_error(self):
+        with self.app.app_context():
+            total = Question.query.count()
+            with self.assertRaises(ValueError):
+                with question_batch():
+                    Question('Which batch fails?', 'This one', '1', 1).insert()
+                    Question('Which batch fails too?', 'This one', '1',
+                             1).insert()
+                    raise ValueError()
+
+            self.assertEqual(Question.query.count(), total)
+
+    def test_update_question_fields(self):
+        created = json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']
+        res = self.client().patch('/questions/{}'.format(created),
+                                  json={'answer': 'new answer', 'version': 1})
+        data = json.loads(res.data)
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], created)
+        self.assertEqual(data['question']['answer'], 'new answer')
+        self.assertEqual(data['question']['question'], 'test question')
+        self.assertEqual(data['question']['version'], 2)
+
+    def test_409_sent_updating_question_with_stale_version(self):
+        created = json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']
+        self.client().patch('/questions/{}'.format(created),
+                            json={'difficulty': 2, 'version': 1})
+        res = self.client().patch('/questions/{}'.format(created),
+                                  json={'difficulty': 3, 'version': 1})
+        data = json.loads(res.data)
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+
+    def test_400_sent_updating_question_with_invalid_field(self):
+        res = self.client().patch('/questions/2',
+                                  json={'difficulty': 'hard'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'difficulty is not an integer')
+
+    def test_404_sent_updating_unknown_question(self):
+        res = self.client().patch('/questions/100000',
+                                  json={'answer': 'nobody'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_delete_questions_by_id(self):
+        created = [json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']
+            for _ in range(2)]
+        res = self.client().delete('/questions?ids={},{}'.format(*created))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], sorted(created))
+
+    def test_400_sent_deleting_questions_without_ids(self):
+        res = self.client().delete('/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_404_sent_deleting_questions_of_unknown_category(self):
+        res = self.client().delete('/categories/1000/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_update_questions_in_bulk(self):
+        created = json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']
+        res = self.client().patch('/questions/bulk', json={
+            'ids': [created], 'category': 2, 'difficulty': 4})
+        data = json.loads(res.data)
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['updated'], [created])
+
+    def test_cors_allows_patch(self):
+        res = self.client().get('/categories')
+
+        self.assertIn('PATCH',
+                      res.headers['Access-Control-Allow-Methods'].split(','))
+
+    def test_400_sent_updating_questions_in_bulk_without_change(self):
+        res = self.client().patch('/questions/bulk', json={'ids': [2]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_sent_updating_questions_in_bulk_without_object(self):
+        res = self.client().patch('/questions/bulk', json=[2, 3])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_delete_question(self):
         #  change for final test
         res = self.client().delete('/questions/38') 
@@ -137,6 +373,373 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 1)
         self.assertEqual(data['current_category'], None)
 
+    def test_search_questions_highlight_matches(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'Clay'}
+        )
+        data = json.loads(res.data)
+        question = data['SearchTerm'][0]
+        start, end = question['highlights']['question'][0]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(question['question'][start:end], 'Clay')
+
+    def test_search_questions_paginated_with_facets(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the', 'limit': 2}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['SearchTerm']), 2)
+        self.assertTrue(data['next_cursor'])
+        self.assertEqual(sum(data['facets']['difficulties'].values()),
+                         data['total_questions'])
+
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the', 'limit': 2,
+                  'cursor': data['next_cursor']}
+        )
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(next_page['SearchTerm'][0], data['SearchTerm'])
+
+    def test_400_sent_searching_questions_before_first_page(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the', 'page': 0}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_search_questions_filtered_by_category_and_difficulty(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the', 'category': 3,
+                  'difficulty_min': 2, 'difficulty_max': 3}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['SearchTerm'])
+        for question in data['SearchTerm']:
+            self.assertEqual(int(question['category']), 3)
+            self.assertIn(question['difficulty'], (2, 3))
+
+    def test_422_sent_searching_questions_with_invalid_filter(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the', 'category': 'Science'}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_search_questions_with_query_syntax(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': '"world cup" OR Clay -Brazil '
+                                'category:sports'}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        for question in data['SearchTerm']:
+            self.assertEqual(int(question['category']), 6)
+            self.assertNotIn('brazil', question['question'].lower())
+
+    def test_422_sent_searching_questions_in_unknown_category(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'the category:unknown'}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_fulltext_search_ranks_and_highlights_matches(self):
+        with self.app.app_context():
+            setup_indexes('fulltext')
+            hits, total, facets = run_search('Clay -Brazil', mode='fulltext')
+
+        self.assertEqual(total, 1)
+        self.assertEqual(sum(facets.categories.values()), 1)
+        question, highlights = hits[0]
+        start, end = highlights['question'][0]
+        self.assertEqual(question.question[start:end], 'Clay')
+
+    def test_trigram_search_matches_ilike_search(self):
+        with self.app.app_context():
+            setup_indexes('trigram')
+            trigram_hits, trigram_total, _ = run_search(
+                'the -Brazil', mode='trigram')
+            hits, total, _ = run_search('the -Brazil', mode='ilike')
+
+        self.assertTrue(trigram_total)
+        self.assertEqual(trigram_total, total)
+        self.assertEqual([question.id for question, _ in trigram_hits],
+                         [question.id for question, _ in hits])
+
+    def test_marked_offsets_of_headline(self):
+        self.assertEqual(
+            marked_offsets('The \x02Mona\x03 \x02Lisa\x03 smiles'),
+            [[4, 8], [9, 13]])
+        self.assertEqual(marked_offsets('No match'), [])
+        self.assertEqual(marked_offsets(None), [])
+
+    def test_search_questions_with_estimated_count(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'Clay', 'count': 'estimated'}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsInstance(data['total_questions'], int)
+
+    def test_search_questions_suggests_spelling(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'Caly'}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 0)
+        self.assertEqual(data['did_you_mean'], 'clay')
+
+    def test_search_questions_with_autocorrect(self):
+        res = self.client().post(
+            '/questions/search',
+            json={'searchTerm': 'Caly', 'autocorrect': True}
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['did_you_mean'], 'clay')
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_search_questions_leaves_short_and_numeric_words(self):
+        for search_term in ['5', 'zz', 'ok', 'Mona Li', '1990s']:
+            res = self.client().post(
+                '/questions/search',
+                json={'searchTerm': search_term, 'autocorrect': True}
+            )
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['total_questions'], 0)
+            self.assertIsNone(data['did_you_mean'])
+
+    def test_search_index_stats(self):
+        res = self.client().get('/questions/search/index')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('bytes', data['index'])
+
+    def memory_search(self, search_term):
+        hits, total, _ = run_search(search_term, mode='memory')
+        self.assertEqual(total, len(hits))
+        return [question.id for question, _ in hits]
+
+    def test_memory_search_ranks_and_follows_writes(self):
+        on_question_change(search_index.on_question_event)
+        with self.app.app_context():
+            self.assertEqual(self.memory_search('zebra'), [])
+            long_question = Question(
+                'Which zebra lives on the plains of eastern Africa?',
+                'Grevy', '1', 2)
+            long_question.insert()
+            short_question = Question('Is a zebra crossing zebra striped?',
+                                      'Yes', '1', 1)
+            short_question.insert()
+            ids = [short_question.id, long_question.id]
+
+            self.assertEqual(self.memory_search('zebra'), ids)
+            self.assertEqual(self.memory_search('zebra -crossing'), ids[1:])
+            self.assertEqual(self.memory_search('"zebra crossing"'), ids[:1])
+            self.assertCountEqual(self.memory_search('grevy OR crossing'),
+                                  ids)
+
+            short_question.delete()
+            self.assertEqual(self.memory_search('zebra'), ids[1:])
+            long_question.delete()
+            self.assertEqual(self.memory_search('zebra'), [])
+
+    def test_search_index_file_round_trip(self):
+        with self.app.app_context():
+            index = InvertedIndex.build(index_rows())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'search_index.bin')
+            write_index(index, path)
+            mapped = MappedIndex(path)
+
+            self.assertEqual(list(mapped), list(index))
+            self.assertEqual(mapped.total_length, index.total_length)
+            for question_id in index:
+                self.assertEqual(mapped.length(question_id),
+                                 index.length(question_id))
+                self.assertEqual(tuple(mapped.attributes(question_id)),
+                                 tuple(index.attributes(question_id)))
+                self.assertEqual(mapped.version(question_id),
+                                 index.version(question_id))
+            for token, (ids, counts) in index.postings.items():
+                mapped_ids, mapped_counts = mapped.posting(token)
+                self.assertEqual(list(mapped_ids), list(ids))
+                self.assertEqual(list(mapped_counts), list(counts))
+            self.assertIsNone(mapped.posting('notindexed'))
+
+    def test_search_index_keeps_updates_across_rebuild(self):
+        def search(index, search_term):
+            return index.search(parse_query(search_term))
+
+        created = json.loads(self.client().post('/questions', json={
+            'question': 'Which river crosses Zanzibarland?',
+            'answer': 'The Zanzi',
+            'category': 3,
+            'difficulty': 2,
+        }).data)['created']
+        with tempfile.TemporaryDirectory() as directory, \
+                self.app.app_context():
+            path = os.path.join(directory, 'search_index.bin')
+            write_index(InvertedIndex.build(index_rows()), path)
+            index = SearchIndex(path=path)
+            index.rebuild()
+            self.assertEqual(search(index, 'zanzibarland'), [created])
+
+            # Edited by another worker: the index is not told
+            update_question(created, {
+                'question': 'Which river crosses Quuxland?'})
+            index.rebuild()
+            self.assertEqual(search(index, 'zanzibarland'), [])
+            self.assertEqual(search(index, 'quuxland'), [created])
+
+            # Edited by this worker, then reloaded
+            index.on_question_event('update', update_question(created, {
+                'answer': 'The Quux'}))
+            self.assertEqual(search(index, 'zanzi'), [])
+            index.rebuild()
+            self.assertEqual(search(index, 'zanzi'), [])
+            self.assertEqual(search(index, 'quux'), [created])
+
+            self.client().delete('/questions/{}'.format(created))
+            index.rebuild()
+            self.assertEqual(search(index, 'quuxland'), [])
+
+    def test_repeated_search_served_from_cache(self):
+        self.client().post('/questions/search', json={'searchTerm': 'title'})
+        before = json.loads(
+            self.client().get('/questions/search/cache').data)['cache']
+        self.client().post('/questions/search', json={'searchTerm': 'TITLE'})
+        res = self.client().get('/questions/search/cache')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['cache']['hits'], before['hits'] + 1)
+
+    def test_search_log_stats(self):
+        res = self.client().get('/questions/search/cache')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('recorded', data['log'])
+        self.assertIn('buffered', data['log'])
+
+    def test_search_log_samples_searches(self):
+        log = QueryLog(sample_rate=0.0)
+        log.record('title', 10, 'exact', SearchFilters(), False)
+        self.assertEqual(log.stats()['recorded'], 0)
+
+        log = QueryLog(sample_rate=1.0, batch_size=100)
+        log.record('title', 10, 'exact', SearchFilters(), False)
+        self.assertEqual(log.stats()['recorded'], 1)
+        self.assertEqual(log.stats()['buffered'], 1)
+
+    def test_search_log_flushes_and_warms_cache(self):
+        search_term = 'logged zebra search'
+        filters = SearchFilters()
+        log = QueryLog(sample_rate=1.0, batch_size=2)
+        with self.app.app_context():
+            logged = SearchLog.query.filter(
+                SearchLog.search_term == search_term).count()
+
+            # A full batch is written at once
+            log.record(' Logged ZEBRA search', 10, 'exact', filters, False)
+            log.record(search_term, 10, 'exact', filters, False)
+            self.assertEqual(log.stats()['written'], 2)
+
+            # A failed write keeps the batch, which is retried later
+            with mock.patch.object(SearchLog.__table__, 'insert',
+                                   side_effect=RuntimeError('down')):
+                log.record(search_term, 10, 'exact', filters, False)
+                log.record(search_term, 10, 'exact', filters, False)
+            self.assertEqual(log.stats()['buffered'], 2)
+            log.record(search_term, 10, 'exact', filters, False)
+            self.assertEqual(log.stats()['buffered'], 3)
+            self.assertEqual(log.flush(), 3)
+            self.assertEqual(log.stats()['written'], 5)
+            self.assertEqual(SearchLog.query.filter(
+                SearchLog.search_term == search_term).count(), logged + 5)
+
+            self.assertIn(search_term, [
+                logged_search.search_term for logged_search
+                in top_searches(1000)])
+            search_cache.clear()
+            self.assertGreater(warm_search_cache(1000), 0)
+            hits = search_cache.stats()['hits']
+            search_page(search_term, 0, 10, 'exact', filters, False)
+            self.assertEqual(search_cache.stats()['hits'], hits + 1)
+
+    def test_search_cache_invalidated_by_created_question(self):
+        search = {'searchTerm': 'cached question'}
+        res = self.client().post('/questions/search', json=search)
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+
+        created = json.loads(self.client().post('/questions', json={
+            'question': 'Which cached question is this?',
+            'answer': 'A new one',
+            'category': 1,
+            'difficulty': 1,
+        }).data)['created']
+        res = self.client().post('/questions/search', json=search)
+        data = json.loads(res.data)
+        self.client().delete('/questions/{}'.format(created))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_suggest_questions(self):
+        res = self.client().get('/questions/suggest?prefix=wha')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('what', data['suggestions'])
+
+    def test_400_sent_suggesting_questions_without_prefix(self):
+        res = self.client().get('/questions/suggest')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_search_questions_without_results(self):
         res = self.client().post(
             '/search',
@@ -147,6 +750,29 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def test_get_related_questions(self):
+        with self.app.app_context():
+            build_related_questions()
+
+        res = self.client().get('/questions/10/related?limit=3')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question_id'], 10)
+        self.assertEqual(len(data['questions']), 3)
+        # Both ask about the soccer World Cup
+        self.assertEqual(data['questions'][0]['id'], 11)
+        self.assertGreater(data['questions'][0]['score'],
+                           data['questions'][1]['score'])
+
+    def test_404_sent_for_related_questions_of_unknown_question(self):
+        res = self.client().get('/questions/100000/related')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     def test_get_questions_by_category(self):
         res = self.client().get('/categories/2/questions?page=1')
         data = json.loads(res.data)
@@ -160,6 +786,18 @@ class TriviaTestCase(unittest.TestCase):
         # self.assertEqual(data['total_questions'], 135)
         self.assertEqual(data['current_categories'], 2)
 
+    def test_category_total_follows_created_questions(self):
+        res = self.client().get('/categories/2/questions')
+        total_before = json.loads(res.data)['total_questions']
+
+        self.client().post('/questions', json=self.new_question)
+        res = self.client().get('/categories/2/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], total_before + 1)
+        self.assertEqual(data['total_questions'], len(data['questions']))
+
     def test_quizzes_with_category_and_without_previous_questions(self):
         res = self.client().post('/quizzes', json={
             'previous_questions': [],
@@ -191,6 +829,210 @@ class TriviaTestCase(unittest.TestCase):
         self.assertIsInstance(data['question'], dict)
 
 
+    def test_quizzes_for_all_categories(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            }
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsInstance(data['question'], dict)
+
+    def test_quizzes_return_no_question_when_category_is_exhausted(self):
+        res = self.client().get('/categories/1/questions')
+        played = [question['id']
+                  for question in json.loads(res.data)['questions']]
+        res = self.client().post('/quizzes', json={
+            'previous_questions': played,
+            'quiz_category': {
+                'type': 'Science',
+                'id': '1'
+            }
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsNone(data['question'])
+
+    def test_422_sent_for_quizzes_with_invalid_category(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {
+                'type': 'Science',
+                'id': 'science'
+            }
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_quizzes_prefetch_distinct_questions(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            },
+            'count': 5
+        })
+        data = json.loads(res.data)
+        played = [question['id'] for question in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(played), 5)
+        self.assertEqual(len(set(played)), 5)
+        self.assertEqual(data['question']['id'], played[0])
+
+    def test_422_sent_for_quizzes_with_invalid_count(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {
+                'type': 'click',
+                'id': 0
+            },
+            'count': 'five'
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_quizzes_with_token_play_each_question_once(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_token': None,
+            'quiz_category': {
+                'type': 'Science',
+                'id': '1'
+            }
+        })
+        data = json.loads(res.data)
+
+        played = []
+        while data['question'] is not None:
+            self.assertEqual(res.status_code, 200)
+            played.append(data['question']['id'])
+            res = self.client().post('/quizzes', json={
+                'quiz_token': data['quiz_token']
+            })
+            data = json.loads(res.data)
+
+        self.assertTrue(played)
+        self.assertEqual(len(played), len(set(played)))
+
+    def test_400_sent_for_quizzes_with_tampered_token(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_token': None,
+            'quiz_category': {
+                'type': 'Science',
+                'id': '1'
+            }
+        })
+        quiz_token = json.loads(res.data)['quiz_token']
+        res = self.client().post('/quizzes', json={
+            'quiz_token': quiz_token + 'x'
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_quiz_session_plays_each_question_once(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {
+                'type': 'Science',
+                'id': '1'
+            }
+        })
+        session_id = json.loads(res.data)['session_id']
+
+        played = []
+        while True:
+            res = self.client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if data['question'] is None:
+                break
+            played.append(data['question']['id'])
+
+        self.assertTrue(played)
+        self.assertEqual(len(played), len(set(played)))
+        self.assertEqual(data['questions_played'], len(played))
+
+    def test_404_sent_for_unknown_quiz_session(self):
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_quiz_index_stats(self):
+        res = self.client().get('/quizzes/index')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['index']['built'])
+        self.assertTrue(data['index']['questions'])
+
+    def test_rebuild_quiz_index(self):
+        res = self.client().post('/quizzes/index/rebuild')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertLess(data['index']['age_seconds'], 1)
+
+    def test_suggestion_index_rebuild_keeps_writes_made_meanwhile(self):
+        index = SuggestionIndex()
+        written = []
+
+        def write_during_rebuild(text):
+            if index._events == [] and not written:
+                written.append(True)
+                index.on_question_event(
+                    'insert', {'id': 99999, 'question': 'Zanzibar'})
+            return tokenize(text)
+
+        with self.app.app_context():
+            with mock.patch('flaskr.suggest.tokenize',
+                            side_effect=write_during_rebuild):
+                index.rebuild()
+
+        self.assertEqual(index.complete('zanz'), ['zanzibar'])
+
+    def test_quiz_index_rebuild_keeps_writes_made_meanwhile(self):
+        index = QuestionIdIndex()
+
+        def write_during_rebuild(category):
+            if index._events == []:
+                index.on_question_event(
+                    'insert', {'id': 99999, 'category': 1})
+            return category_key(category)
+
+        with self.app.app_context():
+            with mock.patch('flaskr.quiz.category_key',
+                            side_effect=write_during_rebuild):
+                index.rebuild()
+
+        self.assertIn(99999, index.ids(0))
+        self.assertIn(99999, index.ids(1))
+
+    def test_405_sent_getting_quiz_index_rebuild(self):
+        res = self.client().get('/quizzes/index/rebuild')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 405)
+        self.assertEqual(data['success'], False)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()